@@ -0,0 +1,217 @@
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from flask import Flask
+
+from halolib.apis import AbsBaseApi, register_api
+from halolib.exceptions import ApiError
+from halolib.saga import load_saga, SagaRollBack
+
+"""
+saga engine benchmark.
+the sagas call in-process stub apis with injected latency and failures, so the time that is not spent in
+the stubs is the engine's own. results are printed (or written to --output) as json.
+
+python benchmarks/bench_saga.py --lengths 1,5,20 --widths 1,4 --failure-rates 0,0.1 --latency-ms 1
+"""
+
+
+class StubApi(AbsBaseApi):
+    """
+    answers in-process after latency_ms, failing forward calls with probability failure_rate
+    """
+    name = "Stub"
+
+    latency_ms = 0
+    failure_rate = 0.0
+    rand = random.Random(0)
+    lock = threading.Lock()
+    calls = 0
+    seconds = 0.0
+
+    @classmethod
+    def configure(cls, latency_ms, failure_rate, seed=0):
+        cls.latency_ms = latency_ms
+        cls.failure_rate = failure_rate
+        cls.rand = random.Random(seed)
+        cls.reset()
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.calls = 0
+            cls.seconds = 0.0
+
+    def get_url_str(self):
+        return "stub://" + self.name, "stub"
+
+    def process(self, method, url, timeout, data=None, headers=None):
+        start = time.time()
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        fail = data["op"] == "step" and self.failure_rate and self.rand.random() < self.failure_rate
+        with self.lock:
+            StubApi.calls += 1
+            StubApi.seconds += time.time() - start
+        if fail:
+            err = ApiError("stub failure")
+            err.status_code = 503
+            err.stack = None
+            raise err
+        return {"status": 200, "op": data["op"]}
+
+
+def call_stub(api, results, payload):
+    return api.post(payload, 1)
+
+
+def make_chain(length):
+    """
+    Step0..StepN-1, each caught by its Undo state, the Undo states chained back to a Fail state
+
+    :param length:
+    :return:
+    """
+    states = {"Failed": {"Type": "Fail"}}
+    for i in range(length):
+        step = {"Type": "Task", "Resource": "Stub", "ResultPath": "$.Step%dResult" % i,
+                "Catch": [{"ErrorEquals": ["States.ALL"], "Next": "Undo%d" % i}]}
+        if i == length - 1:
+            step["End"] = True
+        else:
+            step["Next"] = "Step%d" % (i + 1)
+        states["Step%d" % i] = step
+        states["Undo%d" % i] = {"Type": "Task", "Resource": "Stub", "ResultPath": "$.Undo%dResult" % i,
+                                "Next": "Undo%d" % (i - 1) if i else "Failed"}
+    return {"StartAt": "Step0", "States": states}
+
+
+def make_saga_json(length, width):
+    """
+
+    :param length: Task states per branch
+    :param width: branches of a Parallel state, 1 for a plain chain
+    :return:
+    """
+    if width == 1:
+        return make_chain(length)
+    return {"StartAt": "Fanout", "States": {
+        "Fanout": {"Type": "Parallel", "Branches": [make_chain(length) for _ in range(width)], "End": True,
+                   "ResultPath": None, "Catch": [{"ErrorEquals": ["States.ALL"], "Next": "Failed"}]},
+        "Failed": {"Type": "Fail"}}}
+
+
+def run_sagas(sagax, names, iterations):
+    payloads = {name: {"op": "step" if name.startswith("Step") else "undo"} for name in names}
+    apis = {name: call_stub for name in names}
+    outcomes = {"commit": 0, "rollback": 0, "error": 0}
+    for i in range(iterations):
+        req_context = {"x-correlation-id": "bench-%d" % i}
+        try:
+            sagax.execute(req_context, payloads, apis)
+            outcomes["commit"] += 1
+        except SagaRollBack:
+            outcomes["rollback"] += 1
+        except Exception:
+            outcomes["error"] += 1
+    return outcomes
+
+
+def run_scenario(length, width, failure_rate, latency_ms, iterations, seed=0):
+    """
+    time iterations sagas of one shape, then count allocations on a smaller run
+
+    :param length:
+    :param width:
+    :param failure_rate:
+    :param latency_ms:
+    :param iterations:
+    :param seed:
+    :return: dict
+    """
+    name = "bench.%d.%d" % (length, width)
+    sagax = load_saga(name, make_saga_json(length, width), None)
+    names = ["Step%d" % i for i in range(length)] + ["Undo%d" % i for i in range(length)]
+
+    StubApi.configure(latency_ms, failure_rate, seed)
+    gc.collect()
+    start = time.time()
+    outcomes = run_sagas(sagax, names, iterations)
+    elapsed = time.time() - start
+    calls = StubApi.calls
+    # branches wait on their stubs side by side, so only one branch's share is on the clock
+    engine = max(elapsed - StubApi.seconds / width, 0.0)
+
+    alloc_iterations = max(1, min(iterations, 20))
+    StubApi.configure(latency_ms, failure_rate, seed)
+    gc.collect()
+    collections = sum(stat["collections"] for stat in gc.get_stats())
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    run_sagas(sagax, names, alloc_iterations)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {"length": length, "width": width, "failure_rate": failure_rate, "latency_ms": latency_ms,
+            "iterations": iterations, "outcomes": outcomes, "steps": calls,
+            "seconds": round(elapsed, 6), "stub_seconds": round(StubApi.seconds, 6),
+            "sagas_per_second": round(iterations / elapsed, 2) if elapsed else None,
+            "engine_us_per_step": round(engine / calls * 1000000, 2) if calls else None,
+            "gc_collections_per_saga": round(collections / float(alloc_iterations), 3),
+            "retained_blocks_per_saga": round(blocks / float(alloc_iterations), 1),
+            "peak_kb": round(peak / 1024.0, 1)}
+
+
+def get_app():
+    app = Flask(__name__)
+    app.config.update({"API_CONFIG": {"Stub": {"url": "stub://Stub", "type": "stub"}},
+                       "SAGA_MAX_WORKERS": 10, "SAGA_LOG_STORE": None, "SSM_CONFIG": None})
+    return app
+
+
+def get_list(text, cast):
+    return [cast(item) for item in text.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="saga engine benchmark")
+    parser.add_argument("--lengths", default="1,5,20", help="Task states per branch")
+    parser.add_argument("--widths", default="1,4", help="Parallel branches, 1 for a plain chain")
+    parser.add_argument("--failure-rates", default="0,0.1", help="chance a forward call fails")
+    parser.add_argument("--latency-ms", type=float, default=0, help="stub latency per call")
+    parser.add_argument("--iterations", type=int, default=200, help="sagas per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file, stdout when not set")
+    args = parser.parse_args(argv)
+
+    register_api("Stub", StubApi)
+    results = []
+    with get_app().app_context():
+        for length in get_list(args.lengths, int):
+            for width in get_list(args.widths, int):
+                for failure_rate in get_list(args.failure_rates, float):
+                    results.append(run_scenario(length, width, failure_rate, args.latency_ms, args.iterations,
+                                                args.seed))
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
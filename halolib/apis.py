@@ -1,17 +1,27 @@
 from __future__ import print_function
 
 # python
+import collections
 import datetime
 import importlib
+import json
 import logging
+import threading
 import time
+import uuid
 from abc import ABCMeta
+from concurrent.futures import Future
 
 import requests
 
-from .exceptions import MaxTryHttpException, ApiError
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+from .exceptions import MaxTryHttpException, ApiError, BulkheadFullError
 from .logs import log_json
-from .settingsx import settingsx
+from .settingsx import settingsx, bind_context
 
 try:
     from .util import Util
@@ -29,6 +39,23 @@ headers = {
 
 logger = logging.getLogger(__name__)
 
+sessions = threading.local()
+
+
+def get_session():
+    """
+    a requests session per thread, so the connections to an api are kept alive between calls.
+    the session keeps no cookies, as it serves calls of different requests.
+
+    :return:
+    """
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        sessions.session = session
+    return session
+
 
 def exec_client(req_context, method, url, api_type, timeout, data=None, headers=None):
     """
@@ -46,8 +73,8 @@ def exec_client(req_context, method, url, api_type, timeout, data=None, headers=
     for i in range(0, settings.HTTP_MAX_RETRY):
         try:
             logger.debug("try: " + str(i), extra=log_json(req_context))
-            ret = requests.request(method, url, data=data, headers=headers,
-                                   timeout=timeout)
+            ret = get_session().request(method, url, data=data, headers=headers,
+                                        timeout=timeout)
             logger.debug("status_code=" + str(ret.status_code), extra=log_json(req_context))
             if ret.status_code >= 500:
                 if i > 0:
@@ -76,6 +103,142 @@ def exec_client(req_context, method, url, api_type, timeout, data=None, headers=
     raise MaxTryHttpException(msg)
 
 
+class Bulkhead(object):
+    """
+    Bounds the number of concurrent calls to a downstream dependency.
+    A call that finds the bulkhead full fails fast instead of waiting for a free slot.
+    """
+
+    def __init__(self, name, max_concurrent):
+        """
+
+        :param name:
+        :param max_concurrent:
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.rejected = 0
+        self.__semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+
+        :return:
+        """
+        if not self.__semaphore.acquire(False):
+            with self.__lock:
+                self.rejected += 1
+            err = BulkheadFullError("bulkhead full for: " + self.name)
+            err.status_code = 503
+            err.stack = None
+            raise err
+        with self.__lock:
+            self.active += 1
+
+    def release(self):
+        """
+
+        :return:
+        """
+        with self.__lock:
+            self.active -= 1
+        self.__semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+    def get_stats(self):
+        """
+
+        :return:
+        """
+        with self.__lock:
+            return {"max_concurrent": self.max_concurrent, "active": self.active, "rejected": self.rejected}
+
+
+bulkheads = {}
+bulkheads_lock = threading.Lock()
+
+
+def get_bulkhead(api_name):
+    """
+    API_CONFIG entry can hold "bulkhead": <max_concurrent> or
+    "bulkhead": {"name": <group>, "max_concurrent": <n>} to share one bulkhead between apis.
+    the first api to use a group sets its size.
+
+    :param api_name:
+    :return:
+    """
+    api_config = settings.API_CONFIG
+    if not api_config or api_name not in api_config:
+        return None
+    conf = api_config[api_name].get("bulkhead", None)
+    if not conf:
+        return None
+    if isinstance(conf, dict):
+        group = conf.get("name", api_name)
+        max_concurrent = int(conf["max_concurrent"])
+    else:
+        group = api_name
+        max_concurrent = int(conf)
+    with bulkheads_lock:
+        if group not in bulkheads:
+            bulkheads[group] = Bulkhead(group, max_concurrent)
+        return bulkheads[group]
+
+
+def get_bulkhead_stats():
+    """
+
+    :return:
+    """
+    with bulkheads_lock:
+        items = list(bulkheads.items())
+    return {name: bulkhead.get_stats() for (name, bulkhead) in items}
+
+
+DEFAULT_LATENCY_SAMPLES = 1000
+
+latencies = {}
+latencies_lock = threading.Lock()
+
+
+def record_latency(class_name, milliseconds):
+    """
+    keep the last API_LATENCY_SAMPLES call times of an api class
+
+    :param class_name:
+    :param milliseconds:
+    """
+    with latencies_lock:
+        samples = latencies.get(class_name, None)
+        if samples is None:
+            samples = collections.deque(maxlen=settings.API_LATENCY_SAMPLES or DEFAULT_LATENCY_SAMPLES)
+            latencies[class_name] = samples
+        samples.append(milliseconds)
+
+
+def get_latency_percentile(class_name, percentile):
+    """
+
+    :param class_name:
+    :param percentile: 0-100
+    :return: milliseconds or None when the api was not called yet
+    """
+    with latencies_lock:
+        samples = sorted(latencies.get(class_name, []))
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100.0))]
+
+
 class AbsBaseApi(object):
     __metaclass__ = ABCMeta
 
@@ -83,10 +246,12 @@ class AbsBaseApi(object):
     url = None
     api_type = None
     req_context = None
+    bulkhead = None
 
     def __init__(self, req_context):
         self.req_context = req_context
         self.url, self.api_type = self.get_url_str()
+        self.bulkhead = get_bulkhead(self.name)
 
     def get_url_str(self):
         """
@@ -153,8 +318,14 @@ class AbsBaseApi(object):
         try:
             logger.debug("method: " + str(method) + " url: " + str(url), extra=log_json(self.req_context))
             now = datetime.datetime.now()
-            ret = exec_client(self.req_context, method, url, self.api_type, timeout, data=data, headers=headers)
+            if self.bulkhead:
+                with self.bulkhead:
+                    ret = exec_client(self.req_context, method, url, self.api_type, timeout, data=data,
+                                      headers=headers)
+            else:
+                ret = exec_client(self.req_context, method, url, self.api_type, timeout, data=data, headers=headers)
             total = datetime.datetime.now() - now
+            record_latency(type(self).__name__, int(total.total_seconds() * 1000))
             logger.info("performance_data", extra=log_json(self.req_context,
                                                            {"type": "API", "milliseconds": int(total.total_seconds() * 1000),
                                                        "url": str(url)}))
@@ -265,6 +436,138 @@ class AbsBaseApi(object):
         return self.process(verb, self.url, Util.get_timeout(request), data=data, headers=headers)
 
 
+class ApiBatcher(object):
+    """
+    Collects single item calls to an api and sends them as one request to the api batch url.
+    the batch is sent when it reaches max_size items or window_ms after its first item, whichever comes first.
+    API_CONFIG entry holds "batch": {"url": <batch url>, "max_size": <n>, "window_ms": <ms>, "key": <item id field>}
+    the batch endpoint gets a json list of items and returns a json list of results in the same order,
+    or a json object of results by item key when "key" is set.
+    a batch holds the items of any request. it is sent under the req_context of its first item, and every request
+    with items in it logs the batch id, so the calls of a request can be followed to the batch that carried them.
+    """
+
+    def __init__(self, api_class, timeout=None):
+        """
+
+        :param api_class: AbsBaseApi subclass of the target service
+        :param timeout:
+        """
+        self.api_class = api_class
+        conf = settings.API_CONFIG[api_class.name]["batch"]
+        self.url = conf["url"]
+        self.max_size = int(conf.get("max_size", 10))
+        self.window = float(conf.get("window_ms", 10)) / 1000
+        self.key = conf.get("key", None)
+        if timeout is None:
+            timeout = settings.SERVICE_READ_TIMEOUT_IN_SC
+        self.timeout = timeout
+        self.batches = 0
+        self.items = 0
+        self.__pending = []
+        self.__timer = None
+        self.__lock = threading.Lock()
+
+    def submit(self, req_context, item):
+        """
+
+        :param req_context:
+        :param item:
+        :return: Future of the item result
+        """
+        future = Future()
+        batch = None
+        with self.__lock:
+            self.__pending.append((req_context, item, future))
+            if len(self.__pending) >= self.max_size:
+                batch = self.__take()
+            elif len(self.__pending) == 1:
+                self.__timer = threading.Timer(self.window, bind_context(self.flush))
+                self.__timer.daemon = True
+                self.__timer.start()
+        if batch:
+            self.__send(batch)
+        return future
+
+    def call(self, req_context, item):
+        """
+
+        :param req_context:
+        :param item:
+        :return:
+        """
+        return self.submit(req_context, item).result()
+
+    def call_many(self, req_context, items):
+        """
+
+        :param req_context:
+        :param items:
+        :return: list of results in the order of items
+        """
+        futures = [self.submit(req_context, item) for item in items]
+        self.flush()
+        return [future.result() for future in futures]
+
+    def flush(self):
+        """
+        send whatever is pending now
+
+        :return:
+        """
+        with self.__lock:
+            batch = self.__take()
+        if batch:
+            self.__send(batch)
+
+    def __take(self):
+        batch = self.__pending
+        self.__pending = []
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+        return batch
+
+    def __send(self, batch):
+        req_context = batch[0][0]
+        items = [entry[1] for entry in batch]
+        batch_id = str(uuid.uuid4())
+        contexts = []
+        for entry in batch:
+            if not any(entry[0] is ctx for ctx in contexts):
+                contexts.append(entry[0])
+        for ctx in contexts:
+            logger.info("items sent in batch " + batch_id, extra=log_json(ctx, {"batch_id": batch_id, "url": self.url}))
+        try:
+            api = self.api_class(req_context)
+            api.url = self.url
+            logger.debug("send batch of " + str(len(items)) + " to " + self.url, extra=log_json(req_context, {
+                "batch_id": batch_id, "correlation_ids": [ctx.get("x-correlation-id", None) for ctx in contexts]}))
+            ret = api.post(json.dumps(items), self.timeout, headers={'Content-Type': 'application/json'})
+            if not 200 <= ret.status_code < 300:
+                err = ApiError("error status_code " + str(ret.status_code) + " in : " + self.url)
+                err.status_code = ret.status_code
+                err.stack = None
+                raise err
+            results = ret.json()
+            if self.key:
+                results = [results[str(item[self.key])] for item in items]
+            elif len(results) != len(items):
+                err = ApiError("batch of " + str(len(items)) + " returned " + str(len(results)) + " results")
+                err.status_code = 500
+                err.stack = None
+                raise err
+        except BaseException as e:
+            for entry in batch:
+                entry[2].set_exception(e)
+            return
+        with self.__lock:
+            self.batches += 1
+            self.items += len(items)
+        for entry, result in zip(batch, results):
+            entry[2].set_result(result)
+
+
 class ApiMngr(object):
 
     def __init__(self, req_context):
@@ -291,15 +594,17 @@ class ApiMngr(object):
         :return:
         """
         logger.debug("get_api_insance=" + class_name)
-        module = importlib.import_module(__name__)
-        class_ = getattr(module, class_name)
+        if class_name in api_classes:
+            class_ = api_classes[class_name]
+        else:
+            module = importlib.import_module(__name__)
+            class_ = getattr(module, class_name)
         instance = class_(self.req_context)
         logger.debug("class=" + str(instance))
         return instance
 
 ##################################### lambda #########################
 import boto3
-import json
 
 """
 response = client.invoke(
@@ -340,3 +645,16 @@ class GoogleApi(AbsBaseApi):
 
 
 API_LIST = {"Google": 'GoogleApi'}
+
+api_classes = {}
+
+
+def register_api(name, api_class):
+    """
+    make an api class defined outside this module available to ApiMngr as a saga Resource
+
+    :param name: the Resource name
+    :param api_class: AbsBaseApi subclass
+    """
+    API_LIST[name] = api_class.__name__
+    api_classes[api_class.__name__] = api_class
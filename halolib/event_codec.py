@@ -0,0 +1,275 @@
+from __future__ import print_function
+
+import base64
+import json
+import logging
+import os
+import uuid
+import zlib
+from abc import ABCMeta, abstractmethod
+
+from .exceptions import HaloError
+from .settingsx import settingsx
+
+settings = settingsx()
+
+logger = logging.getLogger(__name__)
+
+"""
+event payload codecs and claim-check.
+an encoded event is {"halo_envelope": {"codec": <name>, "data": <base64 of the encoded message>}}.
+with claim-check the encoded message goes to a blob store and the envelope carries "ref": <blob key> instead of data.
+an event without an envelope is a plain json message, so senders and receivers can be upgraded one at a time.
+"""
+
+ENVELOPE_KEY = "halo_envelope"
+
+
+class AbsEventCodec(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def encode(self, message):
+        """
+
+        :param message: dict
+        :return: bytes
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        """
+
+        :param data: bytes
+        :return: dict
+        """
+        pass
+
+
+class JsonCodec(AbsEventCodec):
+
+    def encode(self, message):
+        return json.dumps(message, separators=(",", ":")).encode("utf8")
+
+    def decode(self, data):
+        return json.loads(data.decode("utf8"))
+
+
+class MsgpackCodec(AbsEventCodec):
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, message):
+        return self.msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class CompressedCodec(AbsEventCodec):
+    """
+    zlib over another codec
+    """
+
+    def __init__(self, codec, level=6):
+        self.codec = codec
+        self.level = level
+
+    def encode(self, message):
+        return zlib.compress(self.codec.encode(message), self.level)
+
+    def decode(self, data):
+        return self.codec.decode(zlib.decompress(data))
+
+
+codec_factories = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+    "json+zlib": lambda: CompressedCodec(JsonCodec()),
+    "msgpack+zlib": lambda: CompressedCodec(MsgpackCodec()),
+}
+codecs = {}
+
+
+def register_codec(name, factory):
+    """
+
+    :param name: the codec name in the envelope
+    :param factory: callable returning an AbsEventCodec
+    """
+    codec_factories[name] = factory
+    codecs.pop(name, None)
+
+
+def get_codec(name):
+    """
+
+    :param name:
+    :return: AbsEventCodec, created on first use
+    """
+    codec = codecs.get(name, None)
+    if codec is None:
+        if name not in codec_factories:
+            raise HaloError("unknown event codec: " + str(name))
+        codec = codec_factories[name]()
+        codecs[name] = codec
+    return codec
+
+
+class AbsBlobStore(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def put(self, key, data):
+        """
+
+        :param key:
+        :param data: bytes
+        """
+        pass
+
+    @abstractmethod
+    def get(self, key):
+        """
+
+        :param key:
+        :return: bytes
+        """
+        pass
+
+
+class LocalBlobStore(AbsBlobStore):
+    """
+    blobs in a local directory, for local runs and tests
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def put(self, key, data):
+        with open(self.get_path(key), "wb") as f:
+            f.write(data)
+
+    def get(self, key):
+        with open(self.get_path(key), "rb") as f:
+            return f.read()
+
+    def get_path(self, key):
+        """
+        the key comes from the event, so a key that is not a plain file name is rejected
+
+        :param key:
+        :return: path of the blob file
+        """
+        if not key or key in (".", "..") or "/" in key or os.sep in key or (os.altsep and os.altsep in key):
+            raise HaloError("bad event blob key: " + str(key))
+        return os.path.join(self.path, key)
+
+
+class S3BlobStore(AbsBlobStore):
+    """
+    blobs in an s3 bucket. a blob is read again when the event is retried, so expire them with a bucket lifecycle rule
+    """
+
+    def __init__(self, bucket):
+        import boto3
+        self.bucket = bucket
+        self.client = boto3.client('s3', region_name=settings.AWS_REGION)
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+
+blob_store = None
+
+
+def get_blob_store():
+    """
+    the store set by EVENT_BLOB_STORE: None for no claim-check, "local" (EVENT_BLOB_PATH) or "s3" (EVENT_BLOB_BUCKET)
+
+    :return:
+    """
+    global blob_store
+    if blob_store is None:
+        kind = settings.EVENT_BLOB_STORE
+        if not kind:
+            return None
+        if kind == "local":
+            blob_store = LocalBlobStore(settings.EVENT_BLOB_PATH)
+        elif kind == "s3":
+            blob_store = S3BlobStore(settings.EVENT_BLOB_BUCKET)
+        else:
+            raise HaloError("unknown event blob store: " + str(kind))
+    return blob_store
+
+
+def set_blob_store(store):
+    """
+
+    :param store: AbsBlobStore or None
+    """
+    global blob_store
+    blob_store = store
+
+
+def encode_event(message, codec_name=None):
+    """
+    encode a message by EVENT_CODEC into the json of the event to send, the message is serialized once.
+    an event of more than EVENT_CLAIM_CHECK_BYTES is put in the blob store.
+    a json message that needs no claim-check is sent as is.
+
+    :param message: dict
+    :param codec_name: EVENT_CODEC when None
+    :return: bytes
+    """
+    codec_name = codec_name or settings.EVENT_CODEC or "json"
+    data = get_codec(codec_name).encode(message)
+    if codec_name == "json":
+        event = data
+    else:
+        event = get_envelope(codec_name, "data", base64.b64encode(data).decode("ascii"))
+    limit = settings.EVENT_CLAIM_CHECK_BYTES
+    store = get_blob_store() if limit and len(event) > limit else None
+    if store is not None:
+        key = str(uuid.uuid4())
+        store.put(key, data)
+        logger.debug("event of " + str(len(event)) + " bytes put in blob: " + key)
+        return get_envelope(codec_name, "ref", key)
+    return event
+
+
+def get_envelope(codec_name, field, value):
+    """
+
+    :param codec_name:
+    :param field: "data" or "ref"
+    :param value: str
+    :return: bytes json of the envelope
+    """
+    return json.dumps({ENVELOPE_KEY: {"codec": codec_name, field: value}}).encode("utf8")
+
+
+def decode_event(event):
+    """
+
+    :param event: dict, an envelope or a plain message
+    :return: dict the message
+    """
+    if not isinstance(event, dict) or ENVELOPE_KEY not in event:
+        return event
+    envelope = event[ENVELOPE_KEY]
+    codec = get_codec(envelope["codec"])
+    if "ref" in envelope:
+        store = get_blob_store()
+        if store is None:
+            raise HaloError("event blob store not set for: " + envelope["ref"])
+        return codec.decode(store.get(envelope["ref"]))
+    return codec.decode(base64.b64decode(envelope["data"]))
@@ -1,9 +1,20 @@
 from __future__ import print_function
 
+import atexit
+import base64
+import collections
 import importlib
 import json
 import logging
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # aws
 import boto3
@@ -17,12 +28,20 @@ try:
     from .util import Util
 except:
     from .flask.utilx import Util
-from .settingsx import settingsx
+from .event_codec import encode_event, decode_event
+from .settingsx import settingsx, bind_context
 
 settings = settingsx()
 
 logger = logging.getLogger(__name__)
 
+BATCH_KEY = "halo_batch"
+# the number of times the failed items of a halo batch were published again
+ATTEMPT_KEY = "halo_attempt"
+# the record sources that report partial batch failures
+BATCH_SOURCES = ("aws:sqs", "aws:kinesis")
+DEFAULT_BATCH_MAX_ATTEMPTS = 3
+
 class NoMessageException(HaloException):
     pass
 
@@ -30,6 +49,218 @@ class NoMessageException(HaloException):
 class NoTargetUrlException(HaloException):
     pass
 
+
+class EventQueueFullException(HaloException):
+    pass
+
+
+class BatchFailedException(HaloException):
+    pass
+
+
+class EventDispatcher(object):
+    """
+    Sends events on a fixed set of worker threads that live as long as the process.
+    submit returns as soon as the event is queued. when the queue is full submit waits
+    up to the queue timeout for a free slot and then fails, so a slow target pushes back on the sender.
+    """
+
+    def __init__(self, workers, max_queue, queue_timeout=0):
+        """
+
+        :param workers: threads sending events
+        :param max_queue: events waiting to be sent
+        :param queue_timeout: seconds submit waits for a free slot
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.submitted = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pending = 0
+        self.total_ms = 0
+        self.max_ms = 0
+        self.__queue = queue.Queue(max_queue)
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__done = threading.Condition(self.__lock)
+
+    def start(self):
+        """
+        start the worker threads, once
+        """
+        with self.__lock:
+            if self.__threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name="halo-event-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        queue a call of func
+
+        :param func:
+        :param args:
+        :param kwargs:
+        """
+        self.start()
+        with self.__lock:
+            self.pending += 1
+        try:
+            if self.queue_timeout:
+                self.__queue.put((time.time(), func, args, kwargs), True, self.queue_timeout)
+            else:
+                self.__queue.put((time.time(), func, args, kwargs), False)
+        except queue.Full:
+            with self.__lock:
+                self.pending -= 1
+                self.rejected += 1
+                self.__done.notify_all()
+            raise EventQueueFullException("event queue full")
+        with self.__lock:
+            self.submitted += 1
+
+    def work(self):
+        while True:
+            queued, func, args, kwargs = self.__queue.get()
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                logger.error("event dispatch failed: " + str(e))
+            ms = int((time.time() - queued) * 1000)
+            with self.__lock:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.dispatched += 1
+                self.total_ms += ms
+                self.max_ms = max(self.max_ms, ms)
+                self.pending -= 1
+                self.__done.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        wait for the queued events to be sent
+
+        :param timeout: seconds, None to wait for all
+        :return: True when nothing is left to send
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__lock:
+            while self.pending > 0:
+                if deadline is None:
+                    self.__done.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    self.__done.wait(left)
+            return self.pending == 0
+
+    def get_stats(self):
+        """
+
+        :return: queue depth, counters and dispatch latency (queued to sent) in milliseconds
+        """
+        with self.__lock:
+            done = self.dispatched + self.failed
+            return {"workers": self.workers, "max_queue": self.max_queue, "queue_depth": self.__queue.qsize(),
+                    "pending": self.pending, "submitted": self.submitted, "dispatched": self.dispatched,
+                    "failed": self.failed, "rejected": self.rejected,
+                    "avg_ms": int(self.total_ms / done) if done else 0, "max_ms": self.max_ms}
+
+
+dispatcher = None
+dispatcher_lock = threading.Lock()
+
+
+def get_event_dispatcher():
+    """
+    the dispatcher of this process, sized by EVENT_DISPATCH_WORKERS and EVENT_QUEUE_SIZE.
+    the events still queued at exit are sent for up to EVENT_DRAIN_TIMEOUT_IN_SC.
+
+    :return:
+    """
+    global dispatcher
+    if dispatcher is None:
+        with dispatcher_lock:
+            if dispatcher is None:
+                dispatcher = EventDispatcher(settings.EVENT_DISPATCH_WORKERS or 1, settings.EVENT_QUEUE_SIZE or 0,
+                                             settings.EVENT_QUEUE_TIMEOUT_IN_SC or 0)
+                atexit.register(dispatcher.drain, settings.EVENT_DRAIN_TIMEOUT_IN_SC)
+    return dispatcher
+
+
+def get_event_stats():
+    """
+
+    :return: stats of the event dispatcher or None before the first local event
+    """
+    if dispatcher is None:
+        return None
+    return dispatcher.get_stats()
+
+
+def post_event(url, messageDict, ctx=None):
+    """
+
+    :param url:
+    :param messageDict:
+    :param ctx:
+    """
+    from .apis import get_session
+    ret = get_session().post(url, data=messageDict, timeout=settings.EVENT_SEND_TIMEOUT_IN_SC)
+    logger.debug("event sent: " + str(ret), extra=log_json(ctx or {}))
+
+
+local_handlers = {}
+
+
+def register_local_handler(target_service, handler):
+    """
+    handler of the events sent to target_service by the local event bus
+
+    :param target_service:
+    :param handler: AbsMainHandler or AbsBaseHandler instance
+    """
+    local_handlers[target_service] = handler
+
+
+def get_local_handler(target_service):
+    """
+
+    :param target_service:
+    :return:
+    """
+    handler = local_handlers.get(target_service, None)
+    if handler is None:
+        raise NoTargetUrlException("no local handler for: " + str(target_service))
+    return handler
+
+
+def deliver_event(handler, messageDict):
+    """
+    call a local handler with a copy of the message, encoded and decoded as the handler of a posted event would get it
+
+    :param handler: AbsMainHandler or AbsBaseHandler instance
+    :param messageDict:
+    """
+    event = decode_event(json.loads(encode_event(messageDict).decode("utf8")))
+    if isinstance(handler, AbsMainHandler):
+        handler.get_event(event, None)
+    else:
+        handler.do_event(event, None)
+
+
 class AbsBaseEvent(object):
     __metaclass__ = ABCMeta
 
@@ -47,13 +278,14 @@ class AbsBaseEvent(object):
             return settings.LOC_TABLE[self.target_service]
         raise NoTargetUrlException("not a local service")
 
-    def send_event(self, messageDict, request=None, ctx=None):
+    def get_message(self, messageDict, request=None, ctx=None):
         """
+        add the event key and the request context to the message
 
         :param messageDict:
         :param request:
         :param ctx:
-        :return:
+        :return: (messageDict, ctx)
         """
         if messageDict:
             messageDict[self.key_name] = self.key_val
@@ -64,16 +296,34 @@ class AbsBaseEvent(object):
                 messageDict.update(ctx)
         else:
             raise NoMessageException("not halo msg")
-        if settings.SERVER_LOCAL:
-            from multiprocessing.dummy import Pool
-            import requests
+        return messageDict, ctx
+
+    def send_local(self, messageDict, ctx=None):
+        """
+        queue a local event: a post to the LOC_TABLE url, or with EVENT_LOCAL_BACKEND 'bus'
+        a direct call of the handler registered for the target service
+
+        :param messageDict:
+        :param ctx:
+        """
+        if settings.EVENT_LOCAL_BACKEND == "bus":
+            handler = get_local_handler(self.target_service)
+            get_event_dispatcher().submit(bind_context(deliver_event), handler, messageDict)
+        else:
             url = self.get_loc_url()
-            pool = Pool(1)
-            futures = []
-            for x in range(1):
-                futures.append(pool.apply_async(requests.post, [url], {'data': messageDict}))
-            for future in futures:
-                logger.debug("future:" + str(future.get()))
+            get_event_dispatcher().submit(bind_context(post_event), url, messageDict, ctx)
+
+    def send_event(self, messageDict, request=None, ctx=None):
+        """
+
+        :param messageDict:
+        :param request:
+        :param ctx:
+        :return:
+        """
+        messageDict, ctx = self.get_message(messageDict, request, ctx)
+        if settings.SERVER_LOCAL:
+            self.send_local(messageDict, ctx)
             return "sent event"
         else:
             try:
@@ -84,7 +334,7 @@ class AbsBaseEvent(object):
                     FunctionName=service_name,
                     InvocationType='Event',
                     LogType='None',
-                    Payload=bytes(json.dumps(messageDict), "utf8")
+                    Payload=encode_event(messageDict)
                 )
             except ClientError as e:
                 logger.error("Unexpected boto client Error", extra=log_json(ctx, messageDict, e))
@@ -94,6 +344,220 @@ class AbsBaseEvent(object):
 
         return ret
 
+    def send_batch(self, messages, ctx=None):
+        """
+        send prepared messages in as few invokes as the payload limit allows, the invokes in parallel.
+        local events are queued one by one, as the local services take single messages.
+
+        :param messages: list of messageDict returned by get_message
+        :param ctx:
+        :return: list of invoke responses
+        """
+        if not messages:
+            return []
+        if settings.SERVER_LOCAL:
+            for messageDict in messages:
+                self.send_local(messageDict, ctx)
+            return ["sent event"] * len(messages)
+        service_name = self.target_service_name[settings.ENV_TYPE]
+        payloads = get_batch_payloads([encode_event(messageDict) for messageDict in messages],
+                                      settings.EVENT_BATCH_MAX_BYTES or 256 * 1024)
+        logger.debug("send " + str(len(messages)) + " events in " + str(len(payloads)) + " invokes to target_service:"
+                     + service_name, extra=log_json(ctx))
+        client = boto3.client('lambda', region_name=settings.AWS_REGION)
+
+        def invoke(payload):
+            try:
+                return client.invoke(FunctionName=service_name, InvocationType='Event', LogType='None',
+                                     Payload=payload)
+            except ClientError as e:
+                logger.error("Unexpected boto client Error", extra=log_json(ctx, {"events": len(messages)}, e))
+                return None
+
+        if len(payloads) == 1:
+            return [invoke(payloads[0])]
+        with ThreadPoolExecutor(max_workers=min(len(payloads), settings.EVENT_BATCH_WORKERS or 1)) as executor:
+            return list(executor.map(invoke, payloads))
+
+
+def get_batch_payloads(messages, max_bytes, attempt=0):
+    """
+    split messages into batch payloads of up to max_bytes. a message larger than max_bytes is sent in a batch of its own
+
+    :param messages: list of dict, or of bytes encoded by encode_event
+    :param max_bytes:
+    :param attempt: the number of times the messages were published before
+    :return: list of bytes
+    """
+    payloads = []
+    items = []
+    size = 0
+    empty = json.dumps({ATTEMPT_KEY: attempt, BATCH_KEY: []} if attempt else {BATCH_KEY: []}).encode("utf8")
+    overhead = len(empty)
+    separator = b", "
+    for messageDict in messages:
+        item = messageDict if isinstance(messageDict, bytes) else json.dumps(messageDict).encode("utf8")
+        if items and overhead + size + len(separator) * len(items) + len(item) > max_bytes:
+            payloads.append(items)
+            items = []
+            size = 0
+        items.append(item)
+        size += len(item)
+    if items:
+        payloads.append(items)
+    return [empty[:-2] + separator.join(items) + empty[-2:] for items in payloads]
+
+
+class EventPublisher(object):
+    """
+    Collects the events of a request by target and sends each target's events as batches.
+    A target is flushed when it holds max_size events, when an event is added max_wait seconds after
+    the target's first one, and when the publisher is flushed or its with block ends.
+
+        with EventPublisher(ctx=ctx) as publisher:
+            publisher.add(Event1Event(), {"name": "david"})
+    """
+
+    def __init__(self, max_size=None, max_wait=None, request=None, ctx=None):
+        """
+
+        :param max_size: events per target before a flush, EVENT_BATCH_SIZE when None
+        :param max_wait: seconds, EVENT_BATCH_WAIT_IN_SC when None
+        :param request:
+        :param ctx:
+        """
+        if request:
+            ctx = Util.get_req_context(request)
+        self.max_size = max_size or settings.EVENT_BATCH_SIZE or 10
+        self.max_wait = max_wait if max_wait is not None else settings.EVENT_BATCH_WAIT_IN_SC
+        self.ctx = ctx
+        self.batches = {}
+        self.__lock = threading.Lock()
+
+    def add(self, event, messageDict):
+        """
+
+        :param event: AbsBaseEvent
+        :param messageDict:
+        """
+        messageDict, ctx = event.get_message(messageDict, None, self.ctx)
+        target = event.target_service
+        now = time.time()
+        with self.__lock:
+            if target not in self.batches:
+                self.batches[target] = (event, now, [])
+            first = self.batches[target][1]
+            messages = self.batches[target][2]
+            messages.append(messageDict)
+            if len(messages) < self.max_size and (not self.max_wait or now - first < self.max_wait):
+                return None
+            del self.batches[target]
+        return event.send_batch(messages, self.ctx)
+
+    def flush(self):
+        """
+        send the collected events of all the targets
+
+        :return: dict target -> list of invoke responses
+        """
+        with self.__lock:
+            batches = self.batches
+            self.batches = {}
+        return {target: batches[target][0].send_batch(batches[target][2], self.ctx) for target in batches}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        return False
+
+
+handler_classes = {}
+handler_instances = {}
+dispatch_indexes = {}
+dispatch_lock = threading.Lock()
+
+
+def get_handler_class(class_name):
+    """
+    the handler class in the MIXIN_HANDLER module, imported once
+
+    :param class_name:
+    :return:
+    """
+    key = (settings.MIXIN_HANDLER, class_name)
+    class_ = handler_classes.get(key, None)
+    if class_ is None:
+        module = importlib.import_module(settings.MIXIN_HANDLER)
+        logger.debug('module : ' + str(module))
+        class_ = getattr(module, class_name)
+        handler_classes[key] = class_
+    return class_
+
+
+def get_handler(class_name):
+    """
+    a new handler, or the shared one when the handler class sets reusable
+
+    :param class_name:
+    :return:
+    """
+    class_ = get_handler_class(class_name)
+    if not getattr(class_, "reusable", False):
+        return class_()
+    instance = handler_instances.get(class_, None)
+    if instance is None:
+        with dispatch_lock:
+            instance = handler_instances.get(class_, None)
+            if instance is None:
+                instance = class_()
+                handler_instances[class_] = instance
+    return instance
+
+
+def get_records(event):
+    """
+    the records of an sqs, kinesis or halo batch event
+
+    :param event:
+    :return: list of (item identifier, partition, record), partition is the fifo group or kinesis partition key
+    """
+    if BATCH_KEY in event:
+        return [(str(i), None, item) for i, item in enumerate(event[BATCH_KEY])]
+    ret = []
+    for record in event["Records"]:
+        if "kinesis" in record:
+            ret.append((record["kinesis"]["sequenceNumber"], record["kinesis"].get("partitionKey", None), record))
+        else:
+            ret.append((record.get("messageId", None), record.get("attributes", {}).get("MessageGroupId", None),
+                        record))
+    return ret
+
+
+def get_record_message(record):
+    """
+
+    :param record: sqs or kinesis record, or a halo message
+    :return: the message dict
+    """
+    if "kinesis" in record:
+        return decode_event(json.loads(base64.b64decode(record["kinesis"]["data"])))
+    if "body" in record and "messageId" in record:
+        return decode_event(json.loads(record["body"]))
+    return decode_event(record)
+
+
+def get_record_context(message):
+    """
+
+    :param message:
+    :return: the request context the sender added to the message
+    """
+    if not isinstance(message, dict):
+        return {}
+    return {key: message[key] for key in ("x-correlation-id", "x-user-agent", "debug-log-enabled") if key in message}
+
 
 class AbsMainHandler(object):
     __metaclass__ = ABCMeta
@@ -101,27 +565,149 @@ class AbsMainHandler(object):
     keys = []
     vals = {}
     classes = {}
+    # message key whose records are processed in order, the fifo group or kinesis partition key when None
+    partition_key = None
+    # records processed at once, EVENT_RECORD_WORKERS when None
+    batch_workers = None
 
     def get_event(self, event, context):
+        """
+        process a single event, a halo batch or the records of an sqs or kinesis batch.
+        a halo batch comes in an async invoke, which ignores the return value, so its failed items
+        are published again as a new batch, see republish.
+
+        :param event:
+        :param context:
+        :return: dict batchItemFailures for sqs and kinesis records
+        """
         logger.debug('get_event : ' + str(event))
+        event = decode_event(event)
+        if BATCH_KEY in event:
+            failures = self.process_batch(event, context)["batchItemFailures"]
+            if failures:
+                self.republish(event, [int(item["itemIdentifier"]) for item in failures], context)
+            return None
+        records = event.get("Records", None)
+        if records and records[0].get("eventSource", None) in BATCH_SOURCES:
+            return self.process_batch(event, context)
         self.process_event(event, context)
 
+    def republish(self, event, indexes, context):
+        """
+        publish the failed items of a halo batch again as a batch of their own, to this function
+        or, on a local server, to this handler through the local event dispatcher.
+        after EVENT_BATCH_MAX_ATTEMPTS the batch fails with BatchFailedException instead,
+        leaving the items to the retries and failure destination of the async invoke.
+
+        :param event: the halo batch
+        :param indexes: list of the positions of the failed items
+        :param context: lambda context
+        """
+        attempt = event.get(ATTEMPT_KEY, 0) + 1
+        items = [event[BATCH_KEY][index] for index in indexes]
+        if attempt >= (settings.EVENT_BATCH_MAX_ATTEMPTS or DEFAULT_BATCH_MAX_ATTEMPTS):
+            raise BatchFailedException("failed batch items after " + str(attempt) + " attempts: " +
+                                       ",".join(str(index) for index in indexes))
+        logger.info("publish " + str(len(items)) + " failed batch items again, attempt " + str(attempt))
+        if settings.SERVER_LOCAL or context is None:
+            get_event_dispatcher().submit(bind_context(self.get_event), {ATTEMPT_KEY: attempt, BATCH_KEY: items},
+                                          None)
+            return
+        client = boto3.client('lambda', region_name=settings.AWS_REGION)
+        for payload in get_batch_payloads(items, settings.EVENT_BATCH_MAX_BYTES or 256 * 1024, attempt):
+            try:
+                client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', LogType='None',
+                              Payload=payload)
+            except ClientError as e:
+                raise BatchFailedException("failed batch items not published: " + str(e))
+
+    def process_batch(self, event, context):
+        """
+        process the records of a batch concurrently, the records of a partition one after the other.
+        once a record of a partition fails, the records after it fail as well, so a retry keeps their order.
+
+        :param event:
+        :param context:
+        :return: dict batchItemFailures with the identifiers of the records to retry
+        """
+        groups = collections.OrderedDict()
+        for i, (item_id, partition, record) in enumerate(get_records(event)):
+            try:
+                message = get_record_message(record)
+            except Exception as e:
+                logger.error("bad record: " + str(item_id), extra=log_json({}, {"record": item_id}, e))
+                message = None
+            if self.partition_key and isinstance(message, dict):
+                partition = message.get(self.partition_key, partition)
+            group = ("partition", partition) if partition is not None else ("record", i)
+            groups.setdefault(group, []).append((item_id, message))
+        failures = []
+        if len(groups) == 1:
+            failures.extend(self.process_group(list(groups.values())[0], context))
+        elif groups:
+            workers = min(len(groups), self.batch_workers or settings.EVENT_RECORD_WORKERS or 1)
+            process_group = bind_context(self.process_group)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for ret in executor.map(lambda items: process_group(items, context), groups.values()):
+                    failures.extend(ret)
+        return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failures]}
+
+    def process_group(self, items, context):
+        """
+
+        :param items: list of (item identifier, message) of one partition, in order
+        :param context:
+        :return: list of the identifiers of the records that failed or were not run
+        """
+        for i, (item_id, message) in enumerate(items):
+            try:
+                if message is None:
+                    raise NoMessageException("bad record")
+                self.process_event(message, context)
+            except Exception as e:
+                logger.error("record failed: " + str(item_id),
+                             extra=log_json(get_record_context(message), {"record": item_id}, e))
+                return [item for item, _ in items[i:]]
+        return []
+
+    def get_index(self):
+        """
+        (key, value) -> (position in keys, class name), built once per handler class
+
+        :return:
+        """
+        index = dispatch_indexes.get(type(self), None)
+        if index is None:
+            index = {}
+            for position, key in enumerate(self.keys):
+                index[(key, self.vals[key])] = (position, self.classes[key])
+            dispatch_indexes[type(self)] = index
+        return index
+
     def process_event(self, event, context):
         """
+        run the handler of every key of the event that has its value, in the order of keys
 
         :param event:
         :param context:
         """
-        for key in self.keys:
-            if key in event:
-                val = self.vals[key]
-                if val == event[key]:
-                    class_name = self.classes[key]
-                    module = importlib.import_module(settings.MIXIN_HANDLER)
-                    logger.debug('module : ' + str(module))
-                    class_ = getattr(module, class_name)
-                    instance = class_()
-                    instance.do_event(event, context)
+        index = self.get_index()
+        if len(event) < len(index):
+            pairs = event.items()
+        else:
+            pairs = [(key, event[key]) for key in self.keys if key in event]
+        matches = []
+        for pair in pairs:
+            try:
+                match = index.get(pair, None)
+            except TypeError:
+                # an unhashable value matches no key
+                continue
+            if match is not None:
+                matches.append(match)
+        matches.sort()
+        for position, class_name in matches:
+            get_handler(class_name).do_event(event, context)
 
 
 class AbsBaseHandler(object):
@@ -129,6 +715,8 @@ class AbsBaseHandler(object):
 
     key_name = None
     key_val = None
+    # one instance serves all the events, set only when process_event keeps no state on self
+    reusable = False
 
     def do_event(self, event, context):
         """
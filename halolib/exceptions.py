@@ -51,6 +51,10 @@ class ApiError(HaloError):
     pass
 
 
+class BulkheadFullError(ApiError):
+    pass
+
+
 class DbError(HaloError):
     pass
 
@@ -12,6 +12,9 @@ import requests
 from flask import Response as HttpResponse
 
 from .utilx import Util, status
+from ..apis import get_bulkhead_stats
+from ..events import get_event_stats
+from ..saga import get_saga_history
 from ..const import HTTPChoice
 from ..exceptions import AuthException
 from ..response import HaloResponse
@@ -189,7 +192,8 @@ class PerfMixinX(AbsBaseMixinX):
         total = datetime.datetime.now() - self.now
         # return HttpResponse('performance page: timing for process: ' + str(total) + " " + str(urls) + " " + ret + " " + settings.VERSION)
         return HaloResponse({"msg": 'performance page: timing for process: ' + str(total) + " " + str(
-            urls) + " " + ret + " " + settings.VERSION}, 200, [])
+            urls) + " " + ret + " " + settings.VERSION, "bulkheads": get_bulkhead_stats(),
+                             "sagas": get_saga_history(), "events": get_event_stats()}, 200, [])
 
 
     def process_db(self, request, vars):
@@ -293,7 +297,7 @@ import json
 from ..logs import log_json
 from ..apis import ApiTest
 from ..exceptions import ApiError, ApiException
-from ..saga import load_saga, SagaRollBack
+from ..saga import get_saga, SagaRollBack
 
 
 class TestMixinX(AbsApiMixinX):
@@ -326,11 +330,7 @@ class TestMixinX(AbsApiMixinX):
 
         if typer == typer.post or typer == typer.put:
             logger.debug("start " + str(typer))
-            with open("C:\\dev\\projects\\halo\halo_lib\\saga.json") as f:
-                jsonx = json.load(f)
-            with open("C:\\dev\\projects\\halo\halo_lib\\schema.json") as f1:
-                schema = json.load(f1)
-            sagax = load_saga("test", jsonx, schema)
+            sagax = get_saga("test")
             payloads = {"BookHotel": {"abc": "def"}, "BookFlight": {"abc": "def"}, "BookRental": {"abc": "def"},
                         "CancelHotel": {"abc": "def"}, "CancelFlight": {"abc": "def"}, "CancelRental": {"abc": "def"}}
             apis = {"BookHotel": self.create_api1, "BookFlight": self.create_api2, "BookRental": self.create_api3,
@@ -17,6 +17,9 @@ from django.template.exceptions import TemplateDoesNotExist
 from rest_framework import status
 from rest_framework.response import Response
 
+from .apis import get_bulkhead_stats
+from .events import get_event_stats
+from .saga import get_saga_history
 from .const import HTTPChoice
 from .exceptions import AuthException
 from .util import Util
@@ -201,7 +204,8 @@ class PerfMixin(AbsBaseMixin):
             ret = self.process_db(request, vars)
         total = datetime.datetime.now() - self.now
         return HttpResponse('performance page: timing for process: ' + str(total) + " " + str(
-            urls) + " " + ret + " " + settings.VERSION)
+            urls) + " " + ret + " " + settings.VERSION + " bulkheads: " + str(get_bulkhead_stats()) + " sagas: " + str(
+            get_saga_history()) + " events: " + str(get_event_stats()))
 
     def process_db(self, request, vars):
         """
@@ -307,7 +311,7 @@ import json
 from .logs import log_json
 from .apis import ApiTest
 from .exceptions import ApiError
-from .saga import load_saga, SagaRollBack
+from .saga import get_saga, SagaRollBack
 class TestMixin(AbsApiMixin):
     def process_api(self, ctx, typer, request, vars):
         self.upc = "123"
@@ -330,11 +334,7 @@ class TestMixin(AbsApiMixin):
 
         if typer == typer.post or typer == typer.put:
             logger.debug("start " + str(typer))
-            with open("C:\\dev\\projects\\halo\halo_lib\\saga.json") as f1:
-                jsonx = json.load(f1)
-            with open("C:\\dev\\projects\\halo\halo_lib\\schema.json") as f2:
-                schema = json.load(f2)
-            sagax = load_saga("test", jsonx, schema)
+            sagax = get_saga("test")
             payloads = {"BookHotel": {"abc": "def"}, "BookFlight": {"abc": "def"}, "BookRental": {"abc": "def"},
                         "CancelHotel": {"abc": "def"}, "CancelFlight": {"abc": "def"}, "CancelRental": {"abc": "def"}}
             apis = {"BookHotel": self.create_api1, "BookFlight": self.create_api2, "BookRental": self.create_api3,
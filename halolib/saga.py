@@ -1,13 +1,41 @@
+import base64
+import collections
+import datetime
+import hashlib
+import hmac
+import inspect
+import json
 import logging
+import operator
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed, wait, FIRST_COMPLETED
+
+from jsonschema.validators import validator_for
 
 from .apis import ApiMngr
-from .base_util import BaseUtil as Util
 from .exceptions import ApiError
 from .exceptions import HaloException, HaloError
 from .logs import log_json
+from .saga_store import get_saga_store, get_completion_store, to_data, from_data, FINISHED_STAGES
+from .settingsx import settingsx, bind_context
+
+settings = settingsx()
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_LOG_BATCH_SIZE = 10
+DEFAULT_RECOVERY_AGE_MS = 15 * 60 * 1000
+DEFAULT_CHECKPOINT_MS = 1000
+DEFAULT_COMPENSATION_MAX_ATTEMPTS = 3
+DEFAULT_COMPENSATION_RETRY_MS = 100
+DEFAULT_HISTORY_SIZE = 100
+INLINE_TOKEN = "inline:"
+
 """
 
 https://github.com/flowpl/saga_py
@@ -43,27 +71,54 @@ class SagaError(HaloError):
         :param exception: BaseException the exception that caused this SagaException
         :param compensation_exceptions: list[BaseException] all exceptions that happened while executing compensations
         """
+        super(SagaError, self).__init__(str(exception))
         self.action = exception
         self.compensations = compensation_exceptions
 
 
+class SagaCheckpoint(object):
+    """
+    Returned by Saga.execute instead of the results when the saga stopped before a state
+    because the lambda time left was too short. pass the token to execute to continue.
+    """
+
+    def __init__(self, token, state):
+        self.token = token
+        self.state = state
+
+
+class SagaTimeoutError(ApiError):
+    """
+    Raised when a state ran out of time, its status code is States.Timeout.
+    """
+    pass
+
+
+class SagaBranchError(ApiError):
+    """
+    Raised by a Parallel state when one of its branches failed and the completed branches were compensated.
+    """
+    pass
+
+
 class Action(object):
     """
     Groups an action with its corresponding compensation. For internal use.
     """
 
-    def __init__(self, name, action_func, compensation, next, result_path):
+    def __init__(self, name, action_func, compensation, next, result_path, retries=None):
         """
 
         :param action: Callable a function executed as the action
         :param compensation: Callable a function that reverses the effects of action
+        :param retries: list of retry policies
         """
-        self.__kwargs = None
         self.__action = action_func
         self.__compensation = compensation
         self.__name = name
         self.__next = next
         self.__result_path = result_path
+        self.__retries = retries or []
 
     def act(self, **kwargs):
         """
@@ -74,20 +129,78 @@ class Action(object):
         :return: dict optional return value of this action
         """
         logger.debug("act " + self.__name)
-        self.__kwargs = kwargs
         return self.__action(**kwargs)
 
-    def compensate(self, error):
+    def run(self, req_context, payloads, apis, results, timeout=None, scope=""):
+        """
+        Execute this action with its own payload and api
+
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param timeout: seconds the action may take, None for no limit
+        :param scope: the branch path of the saga running this action, "" at the top
+        :return: dict optional return value of this action
+        """
+        return self.act(req_context=req_context, payload=payloads[self.__name], exec_api=apis[self.__name],
+                        results=results)
+
+    def get_branches(self, payloads, scope):
+        """
+        the sagas this action runs inside itself, none for a task
+
+        :param payloads:
+        :param scope: the branch path of the saga running this action
+        :return: list of (saga, payloads, scope) one per branch or iteration
+        """
+        return []
+
+    def compensate(self, error, error_name=None):
         """
         Execute the compensation.
+        :param error: the status code of the error
+        :param error_name: the class name of the error
         :return: None
         """
         for comp in self.__compensation:
-            for error_code in comp["error"]:
-                if error_code == "States.ALL" or error_code == error:
-                    return comp["next"]
+            if match_error(comp["error"], error, error_name):
+                return comp["next"]
         raise SagaException("no compensation for : " + self.__name)
 
+    def retry(self, error, error_name=None):
+        """
+        the first retry policy that matches the error
+
+        :param error: the status code of the error
+        :param error_name: the class name of the error
+        :return: int index of the policy or None
+        """
+        for index, policy in enumerate(self.__retries):
+            if match_error(policy["error"], error, error_name):
+                return index
+        return None
+
+    def compensation(self):
+        """
+        the state that reverses this action once it completed - the States.ALL catch or the first catch
+
+        :return:
+        """
+        for comp in self.__compensation:
+            if "States.ALL" in comp["error"]:
+                return comp["next"]
+        if self.__compensation:
+            return self.__compensation[0]["next"]
+        return None
+
+    def name(self):
+        """
+
+        :return:
+        """
+        return self.__name
+
     def next(self):
         """
 
@@ -95,205 +208,1809 @@ class Action(object):
         """
         return self.__next
 
-    def result_path(self):
+    def next_state(self, results):
         """
+        the state to go to once this action completed
 
+        :param results:
         :return:
         """
-        return self.__result_path
-
+        return self.__next
 
-class SagaLog(object):
-    startSaga = "startSaga"
-    endSaga = "endSaga"
-    abortSaga = "abortSaga"
-    errorSaga = "errorSaga"
-    rollbackSaga = "rollbackSaga"
-    commitSaga = "commitSaga"
+    def result_path(self):
+        """
 
-    startTx = "startTx"
-    endTx = "endTx"
-    failTx = "failTx"
+        :return:
+        """
+        return self.__result_path
 
-    def log(self, req_context, saga_stage, name, log_db=False):
+    def retries(self):
         """
 
-        :param req_context:
-        :param saga_stage:
-        :param name:
-        :param log_db:
+        :return:
         """
-        if log_db:
-            # @TODO finish db log for saga
-            # db_logeer(saga_stage + " " + name)
-            logger.debug("db log")
-        logger.info("SagaLog: " + saga_stage + " " + name,
-                    extra=log_json(req_context))
+        return self.__retries
 
-class Saga(object):
+
+class TaskAction(Action):
     """
-    Executes a series of Actions.
-    If one of the actions raises, the compensation for the failed action and for all previous actions
-    are executed in reverse order.
-    Each action can return a dict, that is then passed as kwargs to the next action.
-    While executing compensations possible Exceptions are recorded and raised wrapped in a SagaException once all
-    compensations have been executed.
+    Calls the exec_api of its state with an instance of its api. For internal use.
     """
 
-    def __init__(self, name, actions, start):
+    def __init__(self, name, api, compensation, next, result_path, retries=None, timeout=None, paths=None):
         """
-        :param actions: list[Action]
+
+        :param api: str the api class name
+        :param timeout: the TimeoutSeconds of the state
+        :param paths: StatePaths of the state
         """
-        self.name = name
-        self.actions = actions
-        self.start = start
-        self.slog = SagaLog()
+        super(TaskAction, self).__init__(name, None, compensation, next, result_path, retries)
+        self.api = api
+        self.timeout = timeout
+        self.paths = paths or StatePaths()
 
-    def execute(self, req_context, payloads, apis):
+    def run(self, req_context, payloads, apis, results, timeout=None, scope=""):
         """
-        Execute this Saga.
+        Execute the exec_api of this state.
+        with a timeout, an exec_api that takes a timeout argument gets the effective timeout to pass to its api call.
+        a state with TimeoutSeconds runs on a thread of its own and is abandoned with a States.Timeout error
+        once the effective timeout passes.
+
         :param req_context:
         :param payloads:
         :param apis:
-        :return: None
+        :param results:
+        :param timeout: seconds left for the saga, None for no limit
+        :param scope: not used by a task
+        :return: dict the exec_api return value under the result path
         """
+        logger.debug("act " + self.name())
+        api = ApiMngr(req_context).get_api_instance(self.api)
+        exec_api = apis[self.name()]
+        data = self.paths.input(results)
+        timeout = get_timeout(self.timeout, timeout)
+        if timeout is None:
+            return self.output(exec_api(api, data, payloads[self.name()]))
+        kwargs = {}
+        if accepts_timeout(exec_api):
+            kwargs["timeout"] = timeout
+        if self.timeout is None:
+            return self.output(exec_api(api, data, payloads[self.name()], **kwargs))
+        future = call_async(bind_context(exec_api), api, data, payloads[self.name()], **kwargs)
+        try:
+            return self.output(future.result(timeout))
+        except TimeoutError:
+            raise timeout_error(self.name())
 
-        self.slog.log(req_context, SagaLog.startSaga, self.name)
-        tname = self.start
-        results = {}
-        kwargs = {'results': results}
-        rollback = None
-        for action_index in range(len(self.actions)):
-            try:
-                logger.debug("execute=" + tname)
-                kwargs['req_context'] = req_context
-                kwargs['payload'] = payloads[tname]
-                kwargs['exec_api'] = apis[tname]
-                self.slog.log(req_context, SagaLog.startTx, tname)
-                ret = self.__get_action(tname).act(**kwargs) or {}
-                self.slog.log(req_context, SagaLog.endTx, tname)
-                results.update(ret)
-                kwargs = {'results': results}
-                logger.debug("kwargs=" + str(kwargs))
-                tname = self.__get_action(tname).next()
-                if tname is True:
-                    logger.debug("finished")
-                    break
-            except ApiError as e:
-                self.slog.log(req_context, SagaLog.failTx, tname)
-                self.slog.log(req_context, SagaLog.abortSaga, self.name)
-                logger.debug("ApiError=" + str(e))
-                if rollback is None:
-                    rollback = e
-                    tname = self.__get_action(tname).compensate(e.status_code)
-                else:
-                    raise SagaError(rollback, [e])
-            except BaseException as e:
-                self.slog.log(req_context, SagaLog.failTx, tname)
-                logger.debug("e=" + str(e))
-                self.slog.log(req_context, SagaLog.errorSaga, self.name)
-                raise SagaError(e, [])
+    def output(self, ret):
+        """
 
+        :param ret: the exec_api return value
+        :return: dict the part of ret to keep under the result path, empty for a null ResultPath
+        """
+        if self.paths.discard:
+            return {}
+        return {self.result_path(): self.paths.output(ret)}
 
-            if type(kwargs) is not dict:
-                raise TypeError('action return type should be dict or None but is {}'.format(type(kwargs)))
 
-        if rollback:
-            self.slog.log(req_context, SagaLog.rollbackSaga, self.name)
-            raise SagaRollBack(rollback)
+class StatePaths(object):
+    """
+    InputPath, ResultSelector, OutputPath and a null ResultPath of a Task state, compiled when the saga is loaded.
+    InputPath picks the part of the results the exec_api gets, "$" (the default) for all the results.
+    ResultSelector builds a new result from the exec_api return value, OutputPath then picks the part kept
+    under the ResultPath, and a null ResultPath keeps nothing.
+    """
 
-        self.slog.log(req_context, SagaLog.commitSaga, self.name)
-        return results
+    def __init__(self, input_path=None, result_selector=None, output_path=None, discard=False):
+        """
 
-    def __get_action(self, name):
+        :param input_path: str
+        :param result_selector: dict template, keys ending in .$ take a path of the return value
+        :param output_path: str
+        :param discard: the ResultPath is null
         """
-        Returns an action by index.
+        self.input_path = compile_path(input_path)
+        self.result_selector = compile_selector(result_selector) if result_selector is not None else None
+        self.output_path = compile_path(output_path)
+        self.discard = discard
 
-        :param index: int
-        :return: Action
+    def input(self, results):
         """
-        return self.actions[name]
 
+        :param results:
+        :return:
+        """
+        return self.input_path(results)
 
+    def output(self, ret):
+        """
 
-class SagaBuilder(object):
+        :param ret:
+        :return:
+        """
+        if self.result_selector:
+            ret = self.result_selector(ret)
+        return self.output_path(ret)
+
+
+class ChoiceAction(Action):
     """
-    Build a Saga.
+    Goes to the Next of the first choice rule that matches the results, or to Default. For internal use.
     """
 
-    def __init__(self, name):
-        self.name = name
-        self.actions = {}
+    def __init__(self, name, choices, default):
+        """
 
-    @staticmethod
-    def create(name):
+        :param choices: list of (predicate, next) compiled by compile_choice
+        :param default: the state when no rule matches or None
         """
+        super(ChoiceAction, self).__init__(name, None, [], default, None)
+        self.choices = choices
 
-        :param name:
+    def run(self, req_context, payloads, apis, results, timeout=None, scope=""):
+        """
+        a choice calls no api
+
+        :return: dict empty
+        """
+        return {}
+
+    def next_state(self, results):
+        """
+
+        :param results:
         :return:
         """
-        return SagaBuilder(name)
+        for predicate, next in self.choices:
+            if predicate(results):
+                return next
+        if self.next() is None:
+            raise SagaException("no choice matched in: " + self.name())
+        return self.next()
 
-    def action(self, name, action_func, compensation, next, result_path):
+
+class ParallelAction(Action):
+    """
+    Runs its branches concurrently. For internal use.
+    """
+
+    def __init__(self, name, branches, compensation, next, result_path, retries=None):
         """
-        Add an action and a corresponding compensation.
 
-        :param action: Callable an action to be executed
-        :param compensation: Callable an action that reverses the effects of action
-        :return: SagaBuilder
+        :param branches: list[Saga] one saga per branch
         """
-        action = Action(name, action_func, compensation, next, result_path)
-        self.actions[name] = action
-        return self
+        super(ParallelAction, self).__init__(name, None, compensation, next, result_path, retries)
+        self.branches = branches
 
-    def build(self, start):
+    def run(self, req_context, payloads, apis, results, timeout=None, scope=""):
         """
-        Returns a new Saga ready to execute all actions passed to the builder.
-        :return: Saga
+        Execute all branches, each on a copy of results, and merge their results
+
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param timeout: not applied to the branches
+        :param scope: the branch path of the saga running this state
+        :return: dict the merged results of all branches
         """
-        return Saga(self.name, self.actions, start)
+        logger.debug("act parallel " + self.name())
+        jobs = [(branch, branch_payloads, dict(results), branch_scope) for (branch, branch_payloads, branch_scope) in
+                self.get_branches(payloads, scope)]
+        ret = {}
+        outputs = []
+        for branch_results in execute_branches(req_context, jobs, apis):
+            output = {key: val for (key, val) in branch_results.items() if
+                      key not in results or val is not results[key]}
+            ret.update(output)
+            outputs.append(output)
+        if self.result_path():
+            ret[self.result_path()] = outputs
+        return ret
 
+    def get_branches(self, payloads, scope):
+        """
+        each branch is scoped by its index, so the same state in two branches has its own completion
 
-def load_saga(name, jsonx, schema):
+        :param payloads:
+        :param scope:
+        :return: list of (saga, payloads, scope) one per branch
+        """
+        return [(branch, payloads, scope + "/" + self.name() + "/" + str(index))
+                for index, branch in enumerate(self.branches)]
+
+
+class MapAction(Action):
+    """
+    Runs its iterator once per item, with up to max_concurrency iterations at once. For internal use.
     """
 
-    :param name:
-    :param jsonx:
+    def __init__(self, name, iterator, items_path, max_concurrency, compensation, next, result_path, retries=None):
+        """
+
+        :param iterator: Saga the states to run for each item
+        :param items_path: str path of the items list in the Map state payload
+        :param max_concurrency: int 0 for no limit other than SAGA_MAX_WORKERS
+        """
+        super(MapAction, self).__init__(name, None, compensation, next, result_path, retries)
+        self.iterator = iterator
+        self.items_path = items_path
+        self.max_concurrency = max_concurrency
+
+    def run(self, req_context, payloads, apis, results, timeout=None, scope=""):
+        """
+        Execute the iterator for every item, each item being the payload of the iterator states.
+        a failed iteration compensates itself and every iteration that completed is compensated
+        before the Map state's Catch takes over.
+
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param timeout: not applied to the iterations
+        :param scope: the branch path of the saga running this state
+        :return: dict the list of iteration results in item order under the result path, empty for a null ResultPath
+        """
+        jobs = [(iterator, item_payloads, dict(results), item_scope) for (iterator, item_payloads, item_scope) in
+                self.get_branches(payloads, scope)]
+        logger.debug("act map " + self.name() + " items=" + str(len(jobs)))
+        outputs = []
+        if jobs:
+            for item_results in execute_branches(req_context, jobs, apis, self.max_concurrency):
+                outputs.append({key: val for (key, val) in item_results.items() if
+                                key not in results or val is not results[key]})
+        if not self.result_path():
+            return {}
+        return {self.result_path(): outputs}
+
+    def get_branches(self, payloads, scope):
+        """
+        one iteration per item, scoped by the item index since every iteration runs the same iterator saga
+
+        :param payloads:
+        :param scope:
+        :return: list of (saga, payloads, scope) one per item
+        """
+        items = get_path(payloads.get(self.name(), None), self.items_path)
+        branches = []
+        for index, item in enumerate(items):
+            item_payloads = dict(payloads)
+            for state in self.iterator.actions:
+                item_payloads[state] = item
+            branches.append((self.iterator, item_payloads, scope + "/" + self.name() + "/" + str(index)))
+        return branches
+
+
+def get_path(data, path):
+    """
+    value at a "$.key.key" path in data, "$" is data itself.
+    a key stored whole, as result paths are, is found as well.
+
+    :param data:
+    :param path:
     :return:
     """
-    # validate saga json
-    if schema:
-        Util.assert_valid_schema(jsonx, schema)
-    # process saga
-    try:
-        if "StartAt" in jsonx:
-            start = jsonx["StartAt"]
+    return compile_path(path)(data)
+
+
+def walk_path(val, keys):
+    for key in keys:
+        if isinstance(val, list):
+            val = val[int(key)]
         else:
-            raise HaloError("can not build saga. No StartAt")
-        saga = SagaBuilder.create(name)
-        for state in jsonx["States"]:
-            logger.debug(str(state))
-            if jsonx["States"][state]["Type"] == "Task":
-                api_name = jsonx["States"][state]["Resource"]
-                logger.debug("api_name=" + api_name)
-                api_instance_name = ApiMngr.get_api(api_name)
-                logger.debug("api_instance_name=" + str(api_instance_name))
-                result_path = jsonx["States"][state]["ResultPath"]
-                # action = lambda req_context, payload, api=api_instance_name: ApiMngr(req_context).get_api_instance(api).post(payload)
-                do_run = lambda key, x: {key: x}
-                action = lambda req_context, payload, exec_api, results, result_path=result_path, api=api_instance_name: \
-                    do_run(result_path, exec_api(ApiMngr(req_context).get_api_instance(api), results, payload))
-                comps = []
-                if "Catch" in jsonx["States"][state]:
-                    for item in jsonx["States"][state]["Catch"]:
-                        comp = {"error": item["ErrorEquals"], "next": item["Next"]}
-                        comps.append(comp)
-                if "Next" in jsonx["States"][state]:
-                    next = jsonx["States"][state]["Next"]
-                else:
-                    next = jsonx["States"][state]["End"]
-                saga.action(state, action, comps, next, result_path)
-        return saga.build(start)
-    except BaseException as e:
-        raise HaloError("can not build saga", e)
+            val = val[key]
+    return val
+
+
+def compile_path(path):
+    """
+    function of data that returns the value at path, see get_path.
+    raises KeyError, IndexError or TypeError when path is not in data.
+
+    :param path:
+    :return:
+    """
+    if path is None or path == "$":
+        return lambda data: data
+    keys = path[2:].split(".")
+    # result paths are stored whole as "$.BookHotelResult", so the longest such prefix of path is looked up first
+    prefixes = [("$." + ".".join(keys[:index]), keys[index:]) for index in range(len(keys), 0, -1)]
+
+    def get(data):
+        if isinstance(data, dict):
+            for prefix, rest in prefixes:
+                if prefix in data:
+                    return walk_path(data[prefix], rest)
+        return walk_path(data, keys)
+
+    return get
+
+
+def compile_selector(template):
+    """
+    function of data that fills a ResultSelector template from data
+
+    :param template: dict, the value of a key ending in .$ is a path of data, other values are kept as they are
+    :return:
+    """
+    fields = []
+    for key in template:
+        val = template[key]
+        if key.endswith(".$"):
+            fields.append((key[:-2], compile_path(val), True))
+        elif isinstance(val, dict):
+            fields.append((key, compile_selector(val), True))
+        else:
+            fields.append((key, val, False))
+
+    def select(data):
+        return {key: val(data) if is_path else val for (key, val, is_path) in fields}
+
+    return select
+
+
+def is_string(val):
+    return isinstance(val, str)
+
+
+def is_number(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
+
+def is_boolean(val):
+    return isinstance(val, bool)
+
+
+def parse_timestamp(val):
+    """
 
+    :param val: RFC3339 timestamp such as 2016-03-14T01:59:00Z
+    :return: datetime or None
+    """
+    if not is_string(val):
+        return None
+    text = val.replace("Z", "+0000")
+    if len(text) > 6 and text[-3] == ":" and text[-6] in "+-":
+        text = text[:-3] + text[-2:]
+    for fmt in ("%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S.%f%z"):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+COMPARISONS = {"Equals": operator.eq, "LessThan": operator.lt, "GreaterThan": operator.gt,
+               "LessThanEquals": operator.le, "GreaterThanEquals": operator.ge}
+CHOICE_TYPES = {"String": (is_string, lambda val: val), "Numeric": (is_number, lambda val: val),
+                "Boolean": (is_boolean, lambda val: val), "Timestamp": (parse_timestamp, parse_timestamp)}
+TYPE_TESTS = {"IsNull": lambda val: val is None, "IsString": is_string, "IsNumeric": is_number,
+              "IsBoolean": is_boolean, "IsTimestamp": lambda val: parse_timestamp(val) is not None}
+
+
+def compile_rule(rule):
+    """
+    compile a Choice rule into a predicate of the results, once when the saga is loaded
+
+    :param rule: dict And, Or, Not or Variable with one comparison operator
+    :return: function of results that returns bool
+    """
+    if "And" in rule:
+        predicates = [compile_rule(item) for item in rule["And"]]
+        return lambda results: all(predicate(results) for predicate in predicates)
+    if "Or" in rule:
+        predicates = [compile_rule(item) for item in rule["Or"]]
+        return lambda results: any(predicate(results) for predicate in predicates)
+    if "Not" in rule:
+        predicate = compile_rule(rule["Not"])
+        return lambda results: not predicate(results)
+    variable = compile_path(rule["Variable"])
+    missing = object()
+
+    def get(results, path=variable):
+        try:
+            return path(results)
+        except (KeyError, IndexError, TypeError, ValueError):
+            return missing
+
+    for op in rule:
+        if op == "IsPresent":
+            present = rule[op]
+            return lambda results: (get(results) is not missing) == present
+        if op in TYPE_TESTS:
+            test = TYPE_TESTS[op]
+            expected = rule[op]
+            return lambda results: get(results) is not missing and bool(test(get(results))) == expected
+        if op == "StringMatches":
+            pattern = re.compile("^" + ".*".join(re.escape(part) for part in rule[op].split("*")) + "$")
+            return lambda results: is_string(get(results)) and pattern.match(get(results)) is not None
+        for type_name in CHOICE_TYPES:
+            if not op.startswith(type_name):
+                continue
+            name = op[len(type_name):]
+            by_path = name.endswith("Path")
+            if by_path:
+                name = name[:-len("Path")]
+            if name not in COMPARISONS:
+                continue
+            check, convert = CHOICE_TYPES[type_name]
+            compare = COMPARISONS[name]
+            if by_path:
+                other = compile_path(rule[op])
+                return lambda results: compare_values(get(results), get(results, other), check, convert, compare)
+            value = rule[op]
+            if not check(value):
+                raise HaloError("bad value for " + op + ": " + str(value))
+            value = convert(value)
+            return lambda results: compare_values(get(results), value, check, convert, compare, True)
+    raise HaloError("no comparison operator in choice rule: " + str(rule))
+
+
+def compare_values(val, other, check, convert, compare, converted=False):
+    """
+
+    :param val:
+    :param other:
+    :param check: type test of the operator
+    :param convert:
+    :param compare:
+    :param converted: other is already converted
+    :return:
+    """
+    if not check(val):
+        return False
+    if not converted:
+        if not check(other):
+            return False
+        other = convert(other)
+    return compare(convert(val), other)
+
+
+def compile_choices(choices):
+    """
+
+    :param choices: the Choices list of a Choice state
+    :return: list of (predicate, next)
+    """
+    return [(compile_rule(rule), rule["Next"]) for rule in choices]
+
+
+def match_error(error_equals, error, error_name=None):
+    """
+    does an ErrorEquals list match an error.
+    States.ALL matches any error, States.TaskFailed any error but States.Timeout,
+    other names match the status code or the class name of the error.
+
+    :param error_equals: list of error names
+    :param error: the status code of the error
+    :param error_name: the class name of the error
+    :return: bool
+    """
+    for name in error_equals:
+        if name == "States.ALL":
+            return True
+        if name == "States.TaskFailed" and error != "States.Timeout":
+            return True
+        if name == str(error) or name == error_name:
+            return True
+    return False
+
+
+def get_retry_delay(policy, attempt):
+    """
+    seconds to wait before a retry
+
+    :param policy: retry policy
+    :param attempt: int retries made so far
+    :return:
+    """
+    return policy["interval"] * (policy["backoff"] ** attempt)
+
+
+def get_timeout(state_timeout, timeout):
+    """
+    the effective timeout of a state, the lower of its own and the time left
+
+    :param state_timeout: TimeoutSeconds or None
+    :param timeout: seconds left or None
+    :return:
+    """
+    if state_timeout is None:
+        return timeout
+    if timeout is None:
+        return state_timeout
+    return min(state_timeout, timeout)
+
+
+def accepts_timeout(func):
+    """
+    can func be called with a timeout keyword argument
+
+    :param func:
+    :return:
+    """
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return "timeout" in params or any(p.kind == p.VAR_KEYWORD for p in params.values())
+
+
+def timeout_error(name):
+    """
+
+    :param name: the state that ran out of time
+    :return: SagaTimeoutError with the States.Timeout status code
+    """
+    err = SagaTimeoutError("state timed out: " + name)
+    err.status_code = "States.Timeout"
+    err.stack = None
+    return err
+
+
+def call_async(func, *args, **kwargs):
+    """
+    call func on a new daemon thread, so a state that timed out holds no worker another saga waits for
+
+    :param func:
+    :param args:
+    :param kwargs:
+    :return: Future of the func return value
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def get_idempotency_key(req_context, saga_name, state, scope=""):
+    """
+    fixed size key of a saga step for a request, hashed like AbsModel.get_idempotent_id
+
+    :param req_context:
+    :param saga_name:
+    :param state:
+    :param scope: the branch path of a state inside Parallel branches or Map iterations, "" at the top
+    :return: str or None when the request has no correlation id
+    """
+    correlation_id = req_context.get("x-correlation-id", None)
+    if not correlation_id:
+        return None
+    request_id = correlation_id + "-" + saga_name + "-" + state
+    if scope:
+        request_id = request_id + "-" + scope
+    return hashlib.md5(correlation_id.encode() + request_id.encode()).hexdigest()
+
+
+def sign_token(payload):
+    """
+
+    :param payload: the text of an inline checkpoint token
+    :return: hex hmac of the payload with SECRET_KEY
+    """
+    key = settings.SECRET_KEY
+    if not key:
+        raise SagaException("SECRET_KEY is needed to sign checkpoint tokens")
+    return hmac.new(key.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+def get_status_code(e):
+    """
+    status code of an api error, or of the api error wrapped by a saga exception
+
+    :param e:
+    :return:
+    """
+    if hasattr(e, "status_code"):
+        return e.status_code
+    if e.args and hasattr(e.args[0], "status_code"):
+        return e.args[0].status_code
+    return 500
+
+
+def execute_branches(req_context, jobs, apis, max_concurrency=0):
+    """
+    Run saga branches on a bounded pool.
+    if any branch fails, every branch that completed is compensated and SagaBranchError is raised.
+
+    :param req_context:
+    :param jobs: list of (saga, payloads, results, scope) one per branch
+    :param apis:
+    :param max_concurrency: 0 for the SAGA_MAX_WORKERS limit
+    :return: list of branch results in the order of jobs
+    """
+    max_workers = settings.SAGA_MAX_WORKERS or DEFAULT_MAX_WORKERS
+    if max_concurrency:
+        max_workers = min(max_workers, max_concurrency)
+    max_workers = max(1, min(max_workers, len(jobs)))
+    outcomes = [None] * len(jobs)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for index, (branch, payloads, results, scope) in enumerate(jobs):
+            task = bind_context(branch.slog.bind_trace(branch.execute_branch, scope))
+            futures[executor.submit(task, req_context, payloads, apis, results, scope=scope)] = index
+        for future in as_completed(futures):
+            try:
+                outcomes[futures[future]] = future.result()
+            except BaseException as e:
+                logger.debug("branch failed=" + str(e))
+                errors.append(e)
+                for other in futures:
+                    other.cancel()
+    if not errors:
+        return [outcome[0] for outcome in outcomes]
+    compensation_errors = []
+    for index, outcome in enumerate(outcomes):
+        if outcome:
+            branch, payloads, results, scope = jobs[index]
+            compensate = branch.slog.bind_trace(branch.compensate_branch, scope)
+            compensation_errors.extend(compensate(req_context, payloads, apis, outcome[0], outcome[1], scope))
+    for e in errors:
+        if isinstance(e, SagaError):
+            compensation_errors.extend(e.compensations)
+    if compensation_errors:
+        raise SagaError(errors[0], compensation_errors)
+    err = SagaBranchError("branch failed: " + str(errors[0]))
+    err.status_code = get_status_code(errors[0])
+    err.stack = None
+    raise err
+
+
+class SagaLog(object):
+    startSaga = "startSaga"
+    endSaga = "endSaga"
+    abortSaga = "abortSaga"
+    errorSaga = "errorSaga"
+    rollbackSaga = "rollbackSaga"
+    commitSaga = "commitSaga"
+
+    checkpointSaga = "checkpointSaga"
+    resumeSaga = "resumeSaga"
+
+    startTx = "startTx"
+    endTx = "endTx"
+    failTx = "failTx"
+    retryTx = "retryTx"
+
+    # a startTx is written before its api is called, so a saga killed in a state still shows the state in the log
+    flushes = (startSaga, startTx, errorSaga, rollbackSaga, commitSaga, checkpointSaga)
+    finishes = (errorSaga, rollbackSaga, commitSaga, checkpointSaga)
+
+    def __init__(self, local=None):
+        """
+
+        :param local: threading.local holding the trace of each thread, a new one when None
+        """
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+        self.__local = local if local is not None else threading.local()
+
+    def get_trace(self):
+        """
+        the trace of the saga running on this thread
+
+        :return: SagaTrace or None
+        """
+        return getattr(self.__local, "trace", None)
+
+    def get_scope(self):
+        """
+        the branch path of the Parallel branch or Map iteration running on this thread
+
+        :return: str "" for a saga of its own
+        """
+        return getattr(self.__local, "scope", "")
+
+    def set_trace(self, trace, scope=""):
+        """
+
+        :param trace: SagaTrace or None
+        :param scope: the branch path when trace is the trace of the enclosing saga
+        """
+        self.__local.trace = trace
+        self.__local.scope = scope
+
+    def bind_trace(self, func, scope=None):
+        """
+        bind func to the trace of this thread, for the states of a saga run on other threads.
+        with a scope, func runs a Parallel branch or Map iteration, whose states are spans of the enclosing saga.
+
+        :param func:
+        :param scope: the branch path, the scope of this thread when None
+        :return:
+        """
+        trace = self.get_trace()
+        if scope is None:
+            scope = self.get_scope()
+
+        def wrapper(*args, **kwargs):
+            previous = (self.get_trace(), self.get_scope())
+            self.set_trace(trace, scope)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.set_trace(*previous)
+
+        return wrapper
+
+    def begin(self, req_context, saga_name, payloads, log_db=False):
+        """
+        log the start of a saga
+
+        :param req_context:
+        :param saga_name:
+        :param payloads:
+        :param log_db: write the saga to the durable log when a store is set
+        :return: the saga id in the durable log or None
+        """
+        saga_id = None
+        if log_db and get_saga_store():
+            saga_id = str(uuid.uuid4())
+            self.resume_log(saga_id, saga_name, 0)
+        self.log(req_context, SagaLog.startSaga, saga_name, log_db, saga_id,
+                 {"req_context": req_context, "payloads": payloads})
+        return saga_id
+
+    def resume_log(self, saga_id, saga_name, seq):
+        """
+        continue the durable log of a saga
+
+        :param saga_id:
+        :param saga_name:
+        :param seq: the seq of the next record
+        """
+        with self.__lock:
+            self.__buffers[saga_id] = {"saga_name": saga_name, "seq": seq, "records": []}
+
+    def log(self, req_context, saga_stage, name, log_db=False, saga_id=None, data=None):
+        """
+
+        :param req_context:
+        :param saga_stage:
+        :param name:
+        :param log_db:
+        :param saga_id:
+        :param data: dict kept with the durable record
+        """
+        if log_db and saga_id:
+            self.log_db(req_context, saga_stage, name, saga_id, data)
+        logger.info("SagaLog: " + saga_stage + " " + name,
+                    extra=log_json(req_context))
+        self.trace(req_context, saga_stage, name)
+
+    def trace(self, req_context, saga_stage, name):
+        """
+        time the states of the saga running on this thread.
+        every attempt of a state is logged as performance_data and
+        the spans of the saga are logged together once it ends.
+        a Parallel branch or Map iteration has no trace of its own, its spans go to the trace of the enclosing saga.
+
+        :param req_context:
+        :param saga_stage:
+        :param name:
+        """
+        scope = self.get_scope()
+        if saga_stage in (SagaLog.startSaga, SagaLog.resumeSaga) and not scope:
+            self.set_trace(SagaTrace(name))
+        trace = self.get_trace()
+        if trace is None:
+            return
+        span = trace.event(saga_stage, name, scope)
+        if span:
+            params = {"type": "SAGA", "saga": trace.saga_name}
+            params.update(span)
+            logger.info("performance_data", extra=log_json(req_context, params))
+        if saga_stage in SagaTrace.finishes and not scope and name == trace.saga_name:
+            self.set_trace(None)
+            summary = trace.summary(SagaTrace.finishes[saga_stage])
+            logger.info("SagaTrace: " + name, extra=log_json(req_context, summary))
+            record_history(req_context, summary)
+
+    def log_db(self, req_context, saga_stage, name, saga_id, data):
+        """
+        a startTx is appended right away with the records before it (write ahead), as are the start and end of
+        a saga. the endTx and failTx records after a startTx are held until the next flush or SAGA_LOG_BATCH_SIZE.
+
+        :param req_context:
+        :param saga_stage:
+        :param name:
+        :param saga_id:
+        :param data:
+        """
+        batch_size = settings.SAGA_LOG_BATCH_SIZE or DEFAULT_LOG_BATCH_SIZE
+        records = None
+        with self.__lock:
+            buf = self.__buffers[saga_id]
+            buf["records"].append({"saga_id": saga_id, "seq": buf["seq"], "saga_name": buf["saga_name"],
+                                   "stage": saga_stage, "state": name,
+                                   "correlation_id": req_context.get("x-correlation-id", None),
+                                   "data": to_data(data), "created": int(time.time() * 1000)})
+            buf["seq"] += 1
+            if saga_stage in SagaLog.flushes or len(buf["records"]) >= batch_size:
+                records = buf["records"]
+                buf["records"] = []
+            if saga_stage in SagaLog.finishes:
+                del self.__buffers[saga_id]
+        if records:
+            try:
+                get_saga_store().append(records)
+            except BaseException as e:
+                logger.error("SagaLog: failed to write db log for " + saga_id, extra=log_json(req_context, {}, e))
+
+
+class SagaTrace(object):
+    """
+    Timed spans of one saga execution, a span for every attempt of a state.
+    the state of a span in a Parallel branch or Map iteration is named by its branch path, as "BookTrip/0/BookHotel".
+    """
+
+    outcomes = {SagaLog.endTx: "ok", SagaLog.failTx: "error", SagaLog.retryTx: "retry"}
+    finishes = {SagaLog.commitSaga: "commit", SagaLog.rollbackSaga: "rollback", SagaLog.errorSaga: "error",
+                SagaLog.checkpointSaga: "checkpoint"}
+
+    def __init__(self, saga_name):
+        self.saga_name = saga_name
+        self.start = time.time()
+        self.spans = []
+        self.running = {}
+        self.attempts = {}
+        # the branch paths that are compensating, "" for the saga itself
+        self.compensating = set()
+        self.lock = threading.Lock()
+
+    def event(self, saga_stage, name, scope=""):
+        """
+
+        :param saga_stage:
+        :param name:
+        :param scope: the branch path of a Parallel branch or Map iteration
+        :return: the span a state attempt ended with or None
+        """
+        now = time.time()
+        if scope:
+            name = scope[1:] + "/" + name
+        with self.lock:
+            if saga_stage == SagaLog.abortSaga:
+                self.compensating.add(scope)
+            elif saga_stage == SagaLog.startTx:
+                self.begin(name, now, scope in self.compensating)
+            elif saga_stage in SagaTrace.outcomes and name in self.running:
+                start, attempt, compensation = self.running.pop(name)
+                span = {"state": name, "attempt": attempt, "milliseconds": int((now - start) * 1000),
+                        "outcome": SagaTrace.outcomes[saga_stage], "compensation": compensation}
+                self.spans.append(span)
+                # a retry waits and runs again without a new startTx
+                if saga_stage == SagaLog.retryTx:
+                    self.begin(name, now, compensation)
+                return span
+        return None
+
+    def begin(self, name, now, compensation):
+        """
+        start the span of the next attempt of a state
+
+        :param name:
+        :param now:
+        :param compensation: the state runs to compensate
+        """
+        self.attempts[name] = self.attempts.get(name, 0) + 1
+        self.running[name] = (now, self.attempts[name], compensation)
+
+    def summary(self, outcome):
+        """
+
+        :param outcome:
+        :return: dict
+        """
+        with self.lock:
+            spans = list(self.spans)
+        return {"saga": self.saga_name, "outcome": outcome, "milliseconds": int((time.time() - self.start) * 1000),
+                "spans": spans,
+                "compensation_path": [span["state"] for span in spans if span["compensation"] and
+                                      span["outcome"] == "ok"]}
+
+
+# the traces of the sagas on each thread, shared by all sagas so the branches of a Parallel or Map state
+# can add their spans to the trace of the saga that runs the state
+saga_threads = threading.local()
+
+history = None
+history_counters = {}
+history_lock = threading.Lock()
+
+
+def record_history(req_context, summary):
+    """
+    keep a saga execution in the ring buffer of the last SAGA_HISTORY_SIZE executions of this process
+
+    :param req_context:
+    :param summary: SagaTrace summary
+    """
+    global history
+    entry = {"saga": summary["saga"], "outcome": summary["outcome"], "milliseconds": summary["milliseconds"],
+             "correlation_id": req_context.get("x-correlation-id", None), "ended": int(time.time() * 1000),
+             "states": [[span["state"], span["milliseconds"], span["outcome"]] for span in summary["spans"]]}
+    with history_lock:
+        if history is None:
+            history = collections.deque(maxlen=settings.SAGA_HISTORY_SIZE or DEFAULT_HISTORY_SIZE)
+        history.append(entry)
+        counters = history_counters.get(summary["saga"], None)
+        if counters is None:
+            counters = {"commit": 0, "rollback": 0, "error": 0, "checkpoint": 0, "milliseconds": 0}
+            history_counters[summary["saga"]] = counters
+        counters[summary["outcome"]] += 1
+        counters["milliseconds"] += summary["milliseconds"]
+
+
+def get_saga_history():
+    """
+
+    :return: dict recent: the last executions, newest first, counters: totals per saga since the process started
+    """
+    with history_lock:
+        recent = list(history or [])
+        counters = {name: dict(history_counters[name]) for name in history_counters}
+    recent.reverse()
+    return {"recent": recent, "counters": counters}
+
+
+class Saga(object):
+    """
+    Executes a series of Actions.
+    If one of the actions raises, the compensation for the failed action and for all previous actions
+    are executed in reverse order.
+    Each action can return a dict, that is then passed as kwargs to the next action.
+    While executing compensations possible Exceptions are recorded and raised wrapped in a SagaException once all
+    compensations have been executed.
+    """
+
+    def __init__(self, name, actions, start, fails=None):
+        """
+        :param actions: list[Action]
+        :param fails: list of the Fail states names
+        """
+        self.name = name
+        self.actions = actions
+        self.start = start
+        self.fails = fails or []
+        self.transitions = {state: actions[state].next() for state in actions}
+        self.slog = SagaLog(saga_threads)
+
+    def execute(self, req_context, payloads, apis, context=None, token=None):
+        """
+        Execute this Saga.
+        with a lambda context, the time left is checked before each state and when it is below
+        SAGA_CHECKPOINT_MS the saga stops and returns a SagaCheckpoint.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param context: lambda context
+        :param token: continue from this SagaCheckpoint token
+        :return: dict results or SagaCheckpoint
+        """
+        if token:
+            return self.execute_checkpoint(req_context, payloads, apis, context, token)
+        saga_id = self.slog.begin(req_context, self.name, payloads, True)
+        return self.resume(req_context, payloads, apis, self.start, {}, [], None, saga_id, context)[0]
+
+    def execute_checkpoint(self, req_context, payloads, apis, context, token):
+        """
+        Continue this Saga from a checkpoint, without running the states that completed before it.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param context:
+        :param token:
+        :return: dict results or SagaCheckpoint
+        """
+        data = self.load_checkpoint(token)
+        if data is None or data["saga"] != self.name:
+            raise SagaException("no checkpoint of saga " + self.name + " for: " + token)
+        saga_id = data["saga_id"]
+        if saga_id:
+            records = get_saga_store().get_records(saga_id)
+            if any(record["stage"] in FINISHED_STAGES for record in records):
+                raise SagaException("saga " + saga_id + " already finished, checkpoint not resumed: " + token)
+            self.slog.resume_log(saga_id, self.name, records[-1]["seq"] + 1)
+        self.__log(req_context, SagaLog.resumeSaga, self.name, saga_id, {"token": token})
+        return self.resume(req_context, payloads, apis, data["state"], data["results"], data["completed"], None,
+                           saga_id, context)[0]
+
+    def checkpoint(self, req_context, tname, results, completed, saga_id):
+        """
+        Keep the saga position in the durable store, or in the token itself when there is no store.
+        an inline token is signed with SECRET_KEY, so a caller cannot change the state or results it resumes with.
+        :param req_context:
+        :param tname: the state to continue from
+        :param results:
+        :param completed:
+        :param saga_id:
+        :return: SagaCheckpoint
+        """
+        data = {"saga": self.name, "state": tname, "results": results, "completed": completed, "saga_id": saga_id}
+        store = get_saga_store()
+        if store:
+            token = str(uuid.uuid4())
+            store.save_checkpoint(token, data)
+        else:
+            payload = base64.urlsafe_b64encode(to_data(data).encode()).decode()
+            token = INLINE_TOKEN + payload + "." + sign_token(payload)
+        self.__log(req_context, SagaLog.checkpointSaga, self.name, saga_id, {"token": token, "state": tname})
+        return SagaCheckpoint(token, tname)
+
+    def load_checkpoint(self, token):
+        """
+
+        :param token:
+        :return: dict
+        """
+        if token.startswith(INLINE_TOKEN):
+            payload, _, signature = token[len(INLINE_TOKEN):].rpartition(".")
+            if not payload or not hmac.compare_digest(sign_token(payload), signature):
+                raise SagaException("bad signature for checkpoint of saga " + self.name)
+            return from_data(base64.urlsafe_b64decode(payload.encode()).decode())
+        store = get_saga_store()
+        if not store:
+            raise SagaException("no saga store for checkpoint: " + token)
+        return store.load_checkpoint(token)
+
+    def execute_branch(self, req_context, payloads, apis, results=None, log_db=False, scope=""):
+        """
+        Execute this Saga and keep track of the forward states that completed.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param results: dict the results of the enclosing saga for a branch
+        :param log_db: write the saga to the durable log
+        :param scope: the branch path of a Parallel branch or Map iteration
+        :return: (results, list of completed state names)
+        """
+        saga_id = self.slog.begin(req_context, self.name, payloads, log_db)
+        if results is None:
+            results = {}
+        return self.resume(req_context, payloads, apis, self.start, results, [], None, saga_id, scope=scope)
+
+    def resume(self, req_context, payloads, apis, tname, results, completed, rollback, saga_id=None, context=None,
+               scope=""):
+        """
+        Execute this Saga from a given state.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param tname: the state to start from
+        :param results: dict the results so far
+        :param completed: list of the forward states that completed so far
+        :param rollback: the error that started compensation, None when going forward
+        :param saga_id: the saga id in the durable log
+        :param context: lambda context to checkpoint by
+        :param scope: the branch path of a Parallel branch or Map iteration
+        :return: (results or SagaCheckpoint, list of completed state names)
+        """
+        checkpoint_ms = settings.SAGA_CHECKPOINT_MS or DEFAULT_CHECKPOINT_MS
+        while tname is not True and tname not in self.fails:
+            if rollback is not None and settings.SAGA_PARALLEL_COMPENSATION:
+                self.compensate_all(req_context, payloads, apis, tname, results, rollback, saga_id, completed, scope)
+            if context and rollback is None and context.get_remaining_time_in_millis() < checkpoint_ms:
+                return self.checkpoint(req_context, tname, results, completed, saga_id), completed
+            try:
+                logger.debug("execute=" + tname)
+                self.__log(req_context, SagaLog.startTx, tname, saga_id)
+                # a compensation runs without the forward deadline, only its own TimeoutSeconds applies
+                ret = self.run_action(req_context, tname, payloads, apis, results, saga_id,
+                                      context if rollback is None else None, rollback is None, scope) or {}
+                if type(ret) is not dict:
+                    raise TypeError('action return type should be dict or None but is {}'.format(type(ret)))
+                self.__log(req_context, SagaLog.endTx, tname, saga_id, {"result": ret, "rollback": bool(rollback)})
+                results.update(ret)
+                if rollback is None:
+                    completed.append(tname)
+                logger.debug("results=%s", results)
+                tname = self.__get_action(tname).next_state(results)
+                if tname is True:
+                    logger.debug("finished")
+            except ApiError as e:
+                self.__log(req_context, SagaLog.failTx, tname, saga_id, {"error": str(e),
+                                                                        "status_code": e.status_code,
+                                                                        "error_name": type(e).__name__})
+                self.__log(req_context, SagaLog.abortSaga, self.name, saga_id)
+                logger.debug("ApiError=" + str(e))
+                if rollback is not None:
+                    self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+                    raise SagaError(rollback, [e])
+                rollback = e
+                try:
+                    tname = self.__get_action(tname).compensate(e.status_code, type(e).__name__)
+                except SagaException as ce:
+                    # no Catch matched, the saga ends here with its log flushed and its trace closed
+                    self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+                    raise SagaError(e, [ce])
+            except SagaError as e:
+                self.__log(req_context, SagaLog.failTx, tname, saga_id, {"error": str(e)})
+                self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+                raise e
+            except BaseException as e:
+                self.__log(req_context, SagaLog.failTx, tname, saga_id, {"error": str(e)})
+                logger.debug("e=" + str(e))
+                self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+                raise SagaError(e, [])
+
+        if rollback:
+            self.forget(req_context, completed, payloads, scope)
+            self.__log(req_context, SagaLog.rollbackSaga, self.name, saga_id)
+            raise SagaRollBack(rollback)
+
+        if tname is not True:
+            self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+            raise SagaException("saga reached fail state: " + tname)
+
+        self.__log(req_context, SagaLog.commitSaga, self.name, saga_id)
+        return results, completed
+
+    def run_action(self, req_context, tname, payloads, apis, results, saga_id=None, context=None, idempotent=False,
+                   scope=""):
+        """
+        Run a state, retrying it by the first of its Retry policies that matches the error.
+        with a lambda context, a retry is only made when it leaves SAGA_CHECKPOINT_MS after its wait.
+        an idempotent state that already completed for the request returns its recorded result without running.
+        :param req_context:
+        :param tname:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param saga_id:
+        :param context: lambda context
+        :param idempotent: look up and record the state in the completion store
+        :param scope: the branch path of a Parallel branch or Map iteration
+        :return: dict optional return value of the state
+        """
+        action = self.__get_action(tname)
+        store = None
+        key = None
+        if idempotent:
+            store = get_completion_store()
+        if store:
+            key = get_idempotency_key(req_context, self.name, tname, scope)
+        if key:
+            ret = store.get(key)
+            if ret is not None:
+                logger.debug("completed=" + tname)
+                return ret
+        checkpoint_ms = settings.SAGA_CHECKPOINT_MS or DEFAULT_CHECKPOINT_MS
+        attempts = {}
+        while True:
+            timeout = None
+            if context:
+                timeout = max(context.get_remaining_time_in_millis() - checkpoint_ms, 0) / 1000.0
+            try:
+                ret = action.run(req_context, payloads, apis, results, timeout, scope) or {}
+                if key:
+                    store.put(key, ret)
+                return ret
+            except ApiError as e:
+                index = action.retry(e.status_code, type(e).__name__)
+                if index is None:
+                    raise e
+                policy = action.retries()[index]
+                attempt = attempts.get(index, 0)
+                if attempt >= policy["max_attempts"]:
+                    raise e
+                delay = get_retry_delay(policy, attempt)
+                if context and context.get_remaining_time_in_millis() - delay * 1000 < checkpoint_ms:
+                    raise e
+                attempts[index] = attempt + 1
+                self.__log(req_context, SagaLog.retryTx, tname, saga_id, {"error": str(e),
+                                                                         "status_code": e.status_code,
+                                                                         "attempt": attempt + 1})
+                time.sleep(delay)
+
+    def forget(self, req_context, completed, payloads=None, scope=""):
+        """
+        drop the completions of states that were compensated, so a new attempt of the request runs them again.
+        the completions inside the branches and iterations of a compensated Parallel or Map state are dropped too.
+        :param req_context:
+        :param completed: list of forward state names
+        :param payloads: the saga payloads, needed for the items of a Map state
+        :param scope: the branch path of a Parallel branch or Map iteration
+        """
+        store = get_completion_store()
+        if not store:
+            return
+        for tname in completed:
+            key = get_idempotency_key(req_context, self.name, tname, scope)
+            if key:
+                store.delete(key)
+            for branch, branch_payloads, branch_scope in self.__get_action(tname).get_branches(payloads or {},
+                                                                                                   scope):
+                branch.forget(req_context, list(branch.actions), branch_payloads, branch_scope)
+
+    def compensate_all(self, req_context, payloads, apis, tname, results, rollback, saga_id=None, completed=None,
+                       scope=""):
+        """
+        Run the compensation chain that starts at tname concurrently instead of one state at a time.
+        a failed compensation is retried SAGA_COMPENSATION_MAX_ATTEMPTS times with a doubling wait,
+        so the compensation apis must be idempotent. the Catch of the compensation states is not used.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param tname: the first compensation state
+        :param results:
+        :param rollback: the error that started compensation
+        :param saga_id:
+        :param completed: list of the forward states that completed
+        :param scope: the branch path of a Parallel branch or Map iteration
+        :return: does not return, raises SagaRollBack or SagaError with all the compensation errors
+        """
+        chain = []
+        while tname is not True and tname not in self.fails and tname not in chain:
+            chain.append(tname)
+            tname = self.transitions[tname]
+        max_attempts = settings.SAGA_COMPENSATION_MAX_ATTEMPTS
+        if max_attempts is None:
+            max_attempts = DEFAULT_COMPENSATION_MAX_ATTEMPTS
+        policy = {"error": ["States.ALL"], "max_attempts": max_attempts, "backoff": 2.0,
+                  "interval": (settings.SAGA_COMPENSATION_RETRY_MS or DEFAULT_COMPENSATION_RETRY_MS) / 1000.0}
+        max_workers = max(1, min(settings.SAGA_MAX_WORKERS or DEFAULT_MAX_WORKERS, len(chain)))
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for name in chain:
+                task = bind_context(self.slog.bind_trace(self.compensate_state))
+                futures.append(executor.submit(task, req_context, name, payloads, apis, dict(results), policy,
+                                               saga_id))
+            for future in as_completed(futures):
+                try:
+                    results.update(future.result())
+                except BaseException as e:
+                    errors.append(e)
+        if errors:
+            self.__log(req_context, SagaLog.errorSaga, self.name, saga_id)
+            raise SagaError(rollback, errors)
+        self.forget(req_context, completed or [], payloads, scope)
+        self.__log(req_context, SagaLog.rollbackSaga, self.name, saga_id)
+        raise SagaRollBack(rollback)
+
+    def compensate_state(self, req_context, tname, payloads, apis, results, policy, saga_id=None):
+        """
+        Run one compensation state, retrying any error by policy.
+        :param req_context:
+        :param tname:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param policy: retry policy
+        :param saga_id:
+        :return: dict return value of the state
+        """
+        attempt = 0
+        while True:
+            try:
+                self.__log(req_context, SagaLog.startTx, tname, saga_id)
+                ret = self.__get_action(tname).run(req_context, payloads, apis, results) or {}
+                self.__log(req_context, SagaLog.endTx, tname, saga_id, {"result": ret, "rollback": True})
+                return ret
+            except BaseException as e:
+                self.__log(req_context, SagaLog.failTx, tname, saga_id, {"error": str(e)})
+                if attempt >= policy["max_attempts"]:
+                    raise e
+                time.sleep(get_retry_delay(policy, attempt))
+                attempt = attempt + 1
+
+    def compensate_branch(self, req_context, payloads, apis, results, completed, scope=""):
+        """
+        Reverse a branch that completed, following the compensation of its last completed state.
+        :param req_context:
+        :param payloads:
+        :param apis:
+        :param results:
+        :param completed: list of completed state names
+        :param scope: the branch path of the branch or iteration
+        :return: list of exceptions raised by the compensations
+        """
+        if not completed:
+            return []
+        tname = self.__get_action(completed[-1]).compensation()
+        if tname is None:
+            return [SagaException("no compensation for : " + completed[-1])]
+        self.slog.log(req_context, SagaLog.abortSaga, self.name)
+        while tname is not True and tname not in self.fails:
+            try:
+                logger.debug("compensate=" + tname)
+                self.slog.log(req_context, SagaLog.startTx, tname)
+                ret = self.run_action(req_context, tname, payloads, apis, results) or {}
+                self.slog.log(req_context, SagaLog.endTx, tname)
+                results.update(ret)
+                tname = self.transitions[tname]
+            except BaseException as e:
+                self.slog.log(req_context, SagaLog.failTx, tname)
+                self.slog.log(req_context, SagaLog.errorSaga, self.name)
+                return [e]
+        self.forget(req_context, completed, payloads, scope)
+        self.slog.log(req_context, SagaLog.rollbackSaga, self.name)
+        return []
+
+    def __log(self, req_context, saga_stage, name, saga_id, data=None):
+        self.slog.log(req_context, saga_stage, name, saga_id is not None, saga_id, data)
+
+    def __get_action(self, name):
+        """
+        Returns an action by index.
+
+        :param index: int
+        :return: Action
+        """
+        return self.actions[name]
+
+
+class SagaRecovery(object):
+    """
+    Finishes sagas that started but never finished, as when a lambda timed out in the middle of a saga.
+    by default the states that completed are compensated (backward recovery),
+    with forward the saga is resumed from the state it stopped at, which needs idempotent apis.
+    a saga that was already compensating carries on compensating.
+    """
+
+    def __init__(self, apis, sagas=None, forward=False, age_ms=None):
+        """
+
+        :param apis: dict saga name -> the apis dict the saga is executed with
+        :param sagas: dict saga name -> Saga, sagas not in it are found with get_saga
+        :param forward: resume instead of compensate
+        :param age_ms: only sagas started at least this long ago are recovered
+        """
+        self.apis = apis
+        self.sagas = sagas or {}
+        self.forward = forward
+        self.age_ms = age_ms or settings.SAGA_RECOVERY_AGE_MS or DEFAULT_RECOVERY_AGE_MS
+
+    def run(self):
+        """
+
+        :return: dict saga id -> "commit", "rollback" or "error"
+        """
+        store = get_saga_store()
+        created_before = int(time.time() * 1000) - self.age_ms
+        ret = {}
+        for saga_id in store.get_unfinished(created_before):
+            ret[saga_id] = self.recover(saga_id)
+        return ret
+
+    def recover(self, saga_id):
+        """
+
+        :param saga_id:
+        :return: "commit", "rollback" or "error"
+        """
+        records = get_saga_store().get_records(saga_id)
+        data = from_data(records[0]["data"])
+        req_context = data["req_context"]
+        payloads = data["payloads"]
+        name = records[0]["saga_name"]
+        if name in self.sagas:
+            saga = self.sagas[name]
+        else:
+            saga = get_saga(name)
+        logger.info("SagaRecovery: " + saga_id + " " + name, extra=log_json(req_context))
+        results = {}
+        completed = []
+        rollback = None
+        pending = None
+        tname = saga.start
+        first = None
+        try:
+            for record in records[1:]:
+                rdata = from_data(record["data"]) or {}
+                if record["stage"] == SagaLog.startTx and rollback is None:
+                    pending = record["state"]
+                elif record["stage"] == SagaLog.endTx:
+                    results.update(rdata["result"])
+                    if not rdata["rollback"]:
+                        completed.append(record["state"])
+                    pending = None
+                    tname = saga.actions[record["state"]].next_state(results)
+                elif record["stage"] == SagaLog.failTx and rollback is None and "status_code" in rdata:
+                    rollback = SagaException("recovered saga " + saga_id + " failed on: " + rdata["error"])
+                    pending = None
+                    tname = saga.actions[record["state"]].compensate(rdata["status_code"],
+                                                                     rdata.get("error_name", None))
+                    first = tname
+            if rollback is None and not self.forward:
+                rollback = SagaException("recovered saga " + saga_id)
+                tname = None
+                # the state in flight may have taken effect, so its compensation comes first
+                if pending:
+                    tname = saga.actions[pending].compensation()
+                elif completed:
+                    tname = saga.actions[completed[-1]].compensation()
+            if first and settings.SAGA_PARALLEL_COMPENSATION:
+                # concurrent compensations finish in any order, so the whole chain runs again
+                tname = first
+            saga.slog.resume_log(saga_id, name, records[-1]["seq"] + 1)
+            if tname is None:
+                saga.slog.log(req_context, SagaLog.rollbackSaga, name, True, saga_id)
+                return "rollback"
+            saga.resume(req_context, payloads, self.apis[name], tname, results, completed, rollback, saga_id)
+            return "commit"
+        except SagaRollBack:
+            return "rollback"
+        except BaseException as e:
+            logger.error("SagaRecovery: failed for " + saga_id, extra=log_json(req_context, {}, e))
+            return "error"
+
+
+class SagaBatch(object):
+    """
+    Runs one saga for many payload sets, as a batch job with a saga per order.
+    the sagas run on a bounded pool and share the compiled saga and the api sessions of the pool threads.
+    each saga gets its own correlation id, the request one with the index of its payloads.
+    """
+
+    def __init__(self, saga, apis, max_workers=None):
+        """
+
+        :param saga: Saga
+        :param apis: the apis dict every saga is executed with
+        :param max_workers: sagas running at once, SAGA_MAX_WORKERS when not set
+        """
+        self.saga = saga
+        self.apis = apis
+        self.max_workers = max_workers
+        self.metrics = {}
+
+    def run(self, req_context, payloads_list):
+        """
+        Execute the saga for every payloads and yield each outcome as soon as its saga ends.
+        only a window of twice the workers is queued at a time, so a long list is not held as futures.
+        :param req_context:
+        :param payloads_list: iterable of payloads
+        :return: generator of (index, outcome, value), outcome is commit, rollback, checkpoint or error
+                 and value the saga results, SagaCheckpoint or exception
+        """
+        max_workers = self.max_workers or settings.SAGA_MAX_WORKERS or DEFAULT_MAX_WORKERS
+        counts = {"commit": 0, "rollback": 0, "checkpoint": 0, "error": 0}
+        millis = []
+        start = time.time()
+        jobs = enumerate(payloads_list)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+            for index, payloads in jobs:
+                running[executor.submit(bind_context(self.execute), req_context, index, payloads)] = index
+                if len(running) >= max_workers * 2:
+                    break
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    outcome, value, ms = future.result()
+                    counts[outcome] += 1
+                    millis.append(ms)
+                    for index_next, payloads in jobs:
+                        running[executor.submit(bind_context(self.execute), req_context, index_next, payloads)] = \
+                            index_next
+                        break
+                    yield index, outcome, value
+        seconds = time.time() - start
+        millis.sort()
+        self.metrics = {"sagas": len(millis), "seconds": round(seconds, 3),
+                        "sagas_per_second": round(len(millis) / seconds, 2) if seconds else None,
+                        "p50_milliseconds": millis[len(millis) // 2] if millis else None,
+                        "p95_milliseconds": millis[int(len(millis) * 0.95)] if millis else None}
+        self.metrics.update(counts)
+        params = {"type": "SAGA_BATCH", "saga": self.saga.name}
+        params.update(self.metrics)
+        logger.info("performance_data", extra=log_json(req_context, params))
+
+    def execute(self, req_context, index, payloads):
+        """
+
+        :param req_context:
+        :param index:
+        :param payloads:
+        :return: (outcome, value, milliseconds)
+        """
+        context = dict(req_context)
+        context["x-correlation-id"] = str(req_context.get("x-correlation-id", "")) + "-" + str(index)
+        start = time.time()
+        try:
+            ret = self.saga.execute(context, payloads, self.apis)
+            outcome = "checkpoint" if isinstance(ret, SagaCheckpoint) else "commit"
+        except SagaRollBack as e:
+            outcome, ret = "rollback", e
+        except BaseException as e:
+            outcome, ret = "error", e
+        return outcome, ret, int((time.time() - start) * 1000)
+
+
+class SagaBuilder(object):
+    """
+    Build a Saga.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.actions = {}
+        self.fails = []
+
+    @staticmethod
+    def create(name):
+        """
+
+        :param name:
+        :return:
+        """
+        return SagaBuilder(name)
+
+    def action(self, name, action_func, compensation, next, result_path):
+        """
+        Add an action and a corresponding compensation.
+
+        :param action: Callable an action to be executed
+        :param compensation: Callable an action that reverses the effects of action
+        :return: SagaBuilder
+        """
+        action = Action(name, action_func, compensation, next, result_path)
+        self.actions[name] = action
+        return self
+
+    def task(self, name, api, compensation, next, result_path, retries=None, timeout=None, paths=None):
+        """
+        Add a state that calls an api and a corresponding compensation.
+
+        :param api: str the api class name
+        :param compensation:
+        :param retries: list of retry policies
+        :param timeout: seconds the state may take
+        :param paths: StatePaths
+        :return: SagaBuilder
+        """
+        action = TaskAction(name, api, compensation, next, result_path, retries, timeout, paths)
+        self.actions[name] = action
+        return self
+
+    def choice(self, name, choices, default):
+        """
+        Add a state that picks the next state by the results.
+
+        :param choices: list of (predicate, next)
+        :param default: the state when no choice matches
+        :return: SagaBuilder
+        """
+        action = ChoiceAction(name, choices, default)
+        self.actions[name] = action
+        return self
+
+    def parallel(self, name, branches, compensation, next, result_path, retries=None):
+        """
+        Add a state that runs sagas concurrently and a corresponding compensation.
+
+        :param branches: list[Saga] the branches to run
+        :param compensation:
+        :param retries: list of retry policies
+        :return: SagaBuilder
+        """
+        action = ParallelAction(name, branches, compensation, next, result_path, retries)
+        self.actions[name] = action
+        return self
+
+    def map(self, name, iterator, items_path, max_concurrency, compensation, next, result_path, retries=None):
+        """
+        Add a state that runs a saga for each item of a list and a corresponding compensation.
+
+        :param iterator: Saga the states to run for each item
+        :param items_path: str path of the items list in the state payload
+        :param max_concurrency: int 0 for no limit
+        :param compensation:
+        :param retries: list of retry policies
+        :return: SagaBuilder
+        """
+        action = MapAction(name, iterator, items_path, max_concurrency, compensation, next, result_path, retries)
+        self.actions[name] = action
+        return self
+
+    def fail(self, name):
+        """
+        Add a state that stops the saga.
+
+        :param name:
+        :return: SagaBuilder
+        """
+        self.fails.append(name)
+        return self
+
+    def build(self, start):
+        """
+        Returns a new Saga ready to execute all actions passed to the builder.
+        :return: Saga
+        """
+        return Saga(self.name, self.actions, start, self.fails)
+
+
+def get_compensations(state):
+    """
+
+    :param state:
+    :return:
+    """
+    comps = []
+    if "Catch" in state:
+        for item in state["Catch"]:
+            comp = {"error": item["ErrorEquals"], "next": item["Next"]}
+            comps.append(comp)
+    return comps
+
+
+def get_retries(state):
+    """
+    the Retry policies of a state, with the Step Functions defaults
+
+    :param state:
+    :return:
+    """
+    retries = []
+    if "Retry" in state:
+        for item in state["Retry"]:
+            retry = {"error": item["ErrorEquals"], "interval": item.get("IntervalSeconds", 1),
+                     "max_attempts": item.get("MaxAttempts", 3), "backoff": item.get("BackoffRate", 2.0)}
+            retries.append(retry)
+    return retries
+
+
+def build_saga(name, jsonx):
+    """
+
+    :param name:
+    :param jsonx:
+    :return:
+    """
+    if "StartAt" in jsonx:
+        start = jsonx["StartAt"]
+    else:
+        raise HaloError("can not build saga. No StartAt")
+    saga = SagaBuilder.create(name)
+    for state in jsonx["States"]:
+        logger.debug(str(state))
+        state_type = jsonx["States"][state]["Type"]
+        if state_type == "Fail":
+            saga.fail(state)
+            continue
+        if state_type == "Choice":
+            saga.choice(state, compile_choices(jsonx["States"][state]["Choices"]),
+                        jsonx["States"][state].get("Default", None))
+            continue
+        if "Next" in jsonx["States"][state]:
+            next = jsonx["States"][state]["Next"]
+        else:
+            next = jsonx["States"][state]["End"]
+        # a null ResultPath keeps nothing, a missing one is an error as the results are kept by ResultPath
+        if "ResultPath" not in jsonx["States"][state]:
+            raise HaloError("can not build saga. No ResultPath in " + state)
+        result_path = jsonx["States"][state]["ResultPath"]
+        comps = get_compensations(jsonx["States"][state])
+        retries = get_retries(jsonx["States"][state])
+        if state_type == "Task":
+            api_name = jsonx["States"][state]["Resource"]
+            logger.debug("api_name=" + api_name)
+            api_instance_name = ApiMngr.get_api(api_name)
+            logger.debug("api_instance_name=" + str(api_instance_name))
+            timeout = jsonx["States"][state].get("TimeoutSeconds", None)
+            paths = StatePaths(jsonx["States"][state].get("InputPath", None),
+                               jsonx["States"][state].get("ResultSelector", None),
+                               jsonx["States"][state].get("OutputPath", None), result_path is None)
+            saga.task(state, api_instance_name, comps, next, result_path, retries, timeout, paths)
+        elif state_type == "Parallel":
+            branches = []
+            for index, branch in enumerate(jsonx["States"][state]["Branches"]):
+                branches.append(build_saga(name + "." + state + "." + str(index), branch))
+            saga.parallel(state, branches, comps, next, result_path, retries)
+        elif state_type == "Map":
+            iterator = build_saga(name + "." + state, jsonx["States"][state]["Iterator"])
+            items_path = jsonx["States"][state].get("ItemsPath", "$")
+            max_concurrency = jsonx["States"][state].get("MaxConcurrency", 0)
+            saga.map(state, iterator, items_path, max_concurrency, comps, next, result_path, retries)
+    return saga.build(start)
+
+
+sagas = {}
+# name -> key in sagas of the definition last loaded for the name
+saga_keys = {}
+validators = {}
+saga_files = {}
+sagas_lock = threading.Lock()
+
+
+def get_hash(jsonx):
+    """
+
+    :param jsonx:
+    :return:
+    """
+    return hashlib.md5(json.dumps(jsonx, sort_keys=True).encode()).hexdigest()
+
+
+def get_validator(schema, schema_hash):
+    """
+    schema validator checked and built once per schema
+
+    :param schema:
+    :param schema_hash:
+    :return:
+    """
+    if schema_hash not in validators:
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validators[schema_hash] = cls(schema)
+    return validators[schema_hash]
+
+
+def load_saga(name, jsonx, schema):
+    """
+    compiled sagas are cached by a hash of name, definition and schema, so loading the same saga again is cheap.
+    only the last definition loaded for a name is kept, so a changed saga file does not leave the old one behind.
+
+    :param name:
+    :param jsonx:
+    :return:
+    """
+    schema_hash = None
+    if schema:
+        schema_hash = get_hash(schema)
+    key = name + ":" + get_hash(jsonx) + ":" + str(schema_hash)
+    if key in sagas:
+        return sagas[key]
+    # validate saga json
+    if schema:
+        get_validator(schema, schema_hash).validate(jsonx)
+    # process saga
+    try:
+        saga = build_saga(name, jsonx)
+    except BaseException as e:
+        raise HaloError("can not build saga", e)
+    with sagas_lock:
+        old_key = saga_keys.get(name, None)
+        if old_key != key:
+            sagas.pop(old_key, None)
+        sagas[key] = saga
+        saga_keys[name] = key
+    return saga
+
+
+def load_json(path):
+    """
+
+    :param path:
+    :return:
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_saga(name):
+    """
+    saga by name from the SAGA_CONFIG files, validated against the SAGA_SCHEMA file.
+    files are read once per process and again only when they change.
+
+    :param name:
+    :return:
+    """
+    path = settings.SAGA_CONFIG[name]
+    schema_path = settings.SAGA_SCHEMA
+    mtimes = (os.path.getmtime(path), os.path.getmtime(schema_path) if schema_path else None)
+    entry = saga_files.get(name, None)
+    if entry and entry[0] == mtimes:
+        return entry[1]
+    logger.debug("load saga " + name + " from " + path)
+    schema = None
+    if schema_path:
+        schema = load_json(schema_path)
+    saga = load_saga(name, load_json(path), schema)
+    with sagas_lock:
+        saga_files[name] = (mtimes, saga)
+    return saga
@@ -0,0 +1,268 @@
+from __future__ import print_function
+
+import logging
+import math
+
+from .apis import ApiMngr, get_latency_percentile
+from .saga import get_retries
+
+logger = logging.getLogger(__name__)
+
+"""
+static analysis of saga definitions before deploy.
+the states are a graph with forward edges (Next, Choices, Default) and catch edges.
+the cost of a Task is its api latency percentile, as recorded by the api calls of this process
+or given per Resource, times its attempts plus the retry waits, which is the worst case for the state.
+"""
+
+
+def get_edges(state):
+    """
+
+    :param state:
+    :return: (forward edges, catch edges)
+    """
+    forward = []
+    if "Next" in state:
+        forward.append(state["Next"])
+    for rule in state.get("Choices", []):
+        forward.append(rule["Next"])
+    if "Default" in state:
+        forward.append(state["Default"])
+    catches = [catch["Next"] for catch in state.get("Catch", [])]
+    return forward, catches
+
+
+class SagaAnalyzer(object):
+    """
+    State graph, unreachable states, cycles and worst case latency of a saga definition.
+    """
+
+    def __init__(self, jsonx, latencies=None, percentile=99, map_items=1, default_ms=0):
+        """
+
+        :param jsonx: the saga definition as passed to load_saga
+        :param latencies: dict Resource -> milliseconds, used before the recorded latencies
+        :param percentile: of the recorded latencies
+        :param map_items: items assumed for a Map state
+        :param default_ms: latency of a Task with no known latency and no TimeoutSeconds
+        """
+        self.jsonx = jsonx
+        self.states = jsonx["States"]
+        self.start = jsonx["StartAt"]
+        self.latencies = latencies or {}
+        self.percentile = percentile
+        self.map_items = map_items
+        self.default_ms = default_ms
+        self.unknown = set()
+        self.back_edges = set()
+        self.cycles = []
+        self.costs = {}
+        self.longest = {}
+
+    def analyze(self, timeout_ms=None):
+        """
+
+        :param timeout_ms: the lambda timeout to check the worst case against
+        :return: dict
+        """
+        reachable = self.reachable()
+        self.find_cycles()
+        forward_ms, forward_path = self.get_longest(self.start)
+        comp_ms, comp_path = 0, []
+        worst_ms, worst_path = forward_ms, forward_path
+        for name, (prefix_ms, prefix_path) in self.get_prefixes().items():
+            for catch in get_edges(self.states[name])[1]:
+                ms, path = self.get_longest(catch)
+                if ms > comp_ms:
+                    comp_ms, comp_path = ms, path
+                if prefix_ms + ms > worst_ms:
+                    worst_ms, worst_path = prefix_ms + ms, prefix_path + path
+        ret = {"states": len(self.states),
+               "unreachable": sorted(name for name in self.states if name not in reachable),
+               "cycles": self.cycles,
+               "forward_ms": forward_ms, "forward_path": forward_path,
+               "compensation_ms": comp_ms, "compensation_path": comp_path,
+               "worst_case_ms": worst_ms, "worst_case_path": worst_path,
+               "unknown_latency": sorted(self.unknown)}
+        if timeout_ms is not None:
+            ret["fits"] = worst_ms <= timeout_ms
+        return ret
+
+    def reachable(self):
+        """
+
+        :return: set of the states reachable from StartAt by any edge
+        """
+        seen = set()
+        stack = [self.start]
+        while stack:
+            name = stack.pop()
+            if name in seen or name not in self.states:
+                continue
+            seen.add(name)
+            forward, catches = get_edges(self.states[name])
+            stack.extend(forward + catches)
+        return seen
+
+    def find_cycles(self):
+        """
+        depth first search over all edges, every edge back to a state on the path closes a cycle.
+        a state that catches into itself, as a compensation retried until it passes, is a cycle as well.
+        """
+        done = set()
+        roots = [self.start] + sorted(name for name in self.states if name != self.start)
+        for root in roots:
+            if root in done:
+                continue
+            path = []
+            on_path = set()
+            stack = [(root, iter(self.children(root)))]
+            path.append(root)
+            on_path.add(root)
+            while stack:
+                name, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    path.pop()
+                    on_path.discard(name)
+                    done.add(name)
+                    continue
+                if child in on_path:
+                    self.back_edges.add((name, child))
+                    self.cycles.append(path[path.index(child):] + [child])
+                elif child not in done and child in self.states:
+                    stack.append((child, iter(self.children(child))))
+                    path.append(child)
+                    on_path.add(child)
+
+    def children(self, name):
+        forward, catches = get_edges(self.states[name])
+        return forward + catches
+
+    def forward(self, name):
+        """
+
+        :param name:
+        :return: forward edges of a state without the edges that close cycles
+        """
+        return [child for child in get_edges(self.states[name])[0] if (name, child) not in self.back_edges and
+                child in self.states]
+
+    def get_longest(self, name):
+        """
+
+        :param name:
+        :return: (milliseconds, path) of the slowest forward path from name to an end
+        """
+        if name in self.longest:
+            return self.longest[name]
+        if name not in self.states:
+            return 0, []
+        self.longest[name] = (0, [name])
+        best_ms, best_path = 0, []
+        for child in self.forward(name):
+            ms, path = self.get_longest(child)
+            if ms > best_ms or not best_path:
+                best_ms, best_path = ms, path
+        ret = (self.get_cost(name) + best_ms, [name] + best_path)
+        self.longest[name] = ret
+        return ret
+
+    def get_prefixes(self):
+        """
+
+        :return: dict state -> (milliseconds, path) of the slowest forward path from StartAt up to and with the state
+        """
+        order = []
+        seen = set()
+
+        def visit(name):
+            if name in seen or name not in self.states:
+                return
+            seen.add(name)
+            for child in self.forward(name):
+                visit(child)
+            order.append(name)
+
+        visit(self.start)
+        prefixes = {self.start: (self.get_cost(self.start), [self.start])}
+        for name in reversed(order):
+            if name not in prefixes:
+                continue
+            ms, path = prefixes[name]
+            for child in self.forward(name):
+                child_ms = ms + self.get_cost(child)
+                if child not in prefixes or child_ms > prefixes[child][0]:
+                    prefixes[child] = (child_ms, path + [child])
+        return prefixes
+
+    def get_cost(self, name):
+        """
+
+        :param name:
+        :return: worst case milliseconds of a state
+        """
+        if name not in self.costs:
+            self.costs[name] = self.compute_cost(self.states[name])
+        return self.costs[name]
+
+    def compute_cost(self, state):
+        state_type = state["Type"]
+        if state_type == "Parallel":
+            return max([self.analyze_branch(branch) for branch in state["Branches"]] or [0])
+        if state_type == "Map":
+            concurrency = state.get("MaxConcurrency", 0) or self.map_items
+            return int(math.ceil(self.map_items / float(concurrency))) * self.analyze_branch(state["Iterator"])
+        if state_type != "Task":
+            return 0
+        call_ms = self.get_latency(state)
+        attempts = 1
+        waits = 0
+        for policy in get_retries(state):
+            waits = max(waits, sum(policy["interval"] * 1000 * policy["backoff"] ** i
+                                   for i in range(policy["max_attempts"])))
+            attempts = max(attempts, 1 + policy["max_attempts"])
+        return int(call_ms * attempts + waits)
+
+    def get_latency(self, state):
+        """
+
+        :param state: a Task state
+        :return: milliseconds of one call
+        """
+        resource = state["Resource"]
+        ms = self.latencies.get(resource, None)
+        if ms is None:
+            class_name = ApiMngr.get_api(resource)
+            if class_name:
+                ms = get_latency_percentile(class_name, self.percentile)
+        timeout_ms = state["TimeoutSeconds"] * 1000 if "TimeoutSeconds" in state else None
+        if ms is None:
+            self.unknown.add(resource)
+            ms = timeout_ms if timeout_ms is not None else self.default_ms
+        elif timeout_ms is not None:
+            ms = min(ms, timeout_ms)
+        return ms
+
+    def analyze_branch(self, jsonx):
+        branch = SagaAnalyzer(jsonx, self.latencies, self.percentile, self.map_items, self.default_ms)
+        ret = branch.analyze()
+        self.unknown.update(ret["unknown_latency"])
+        return ret["worst_case_ms"]
+
+
+def analyze_saga(jsonx, latencies=None, percentile=99, map_items=1, default_ms=0, timeout_ms=None):
+    """
+    analyze a saga definition
+
+    :param jsonx: the saga definition as passed to load_saga
+    :param latencies: dict Resource -> milliseconds
+    :param percentile: of the latencies recorded by the api calls
+    :param map_items: items assumed for a Map state
+    :param default_ms: latency of a Task with no known latency
+    :param timeout_ms: the lambda timeout
+    :return: dict with unreachable, cycles, forward_ms, compensation_ms, worst_case_ms and their paths
+    """
+    return SagaAnalyzer(jsonx, latencies, percentile, map_items, default_ms).analyze(timeout_ms)
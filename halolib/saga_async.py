@@ -0,0 +1,201 @@
+import asyncio
+import inspect
+import logging
+
+from .apis import ApiMngr
+from .exceptions import ApiError
+from .saga import SagaLog, SagaException, SagaRollBack, SagaError, TaskAction, ChoiceAction, get_retry_delay, \
+    get_timeout, accepts_timeout, timeout_error, get_idempotency_key
+from .saga_store import get_completion_store
+
+logger = logging.getLogger(__name__)
+
+"""
+asyncio executor for sagas (python 3.5+).
+runs a saga built by load_saga on the event loop, one awaited exec_api per state,
+so a coroutine waiting on a slow api does not hold a thread.
+"""
+
+
+class AsyncSaga(object):
+    """
+    Executes a Saga of Task and Choice states on an asyncio event loop.
+    The exec_api of a state is called with (api, results, payload) and may return an awaitable.
+    Retry, Catch, Next, End, Fail and the SagaLog events are the same as for Saga.execute.
+    When the deadline or the TimeoutSeconds of a state passes, the running state is cancelled
+    and fails with States.Timeout. the compensation chain runs without the saga deadline.
+    """
+
+    def __init__(self, saga):
+        """
+
+        :param saga: Saga
+        """
+        for name in saga.actions:
+            if not isinstance(saga.actions[name], (TaskAction, ChoiceAction)):
+                raise SagaException("AsyncSaga runs Task and Choice states only, not: " + name)
+        self.saga = saga
+        self.name = saga.name
+
+    async def execute(self, req_context, payloads, apis, timeout=None, context=None):
+        """
+        Execute this Saga.
+        :param req_context:
+        :param payloads:
+        :param apis: dict of state name to exec_api
+        :param timeout: seconds for the forward states
+        :param context: lambda context, its remaining time bounds the deadline
+        :return: dict results
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None
+        if timeout is not None:
+            deadline = loop.time() + timeout
+        if context:
+            remaining = loop.time() + context.get_remaining_time_in_millis() / 1000.0
+            if deadline is None or remaining < deadline:
+                deadline = remaining
+        # a log per execution, as the traces of coroutines on one thread must not mix
+        slog = SagaLog()
+        saga_id = slog.begin(req_context, self.name, payloads, True)
+        tname = self.saga.start
+        results = {}
+        completed = []
+        rollback = None
+        while tname is not True and tname not in self.saga.fails:
+            try:
+                logger.debug("execute=" + tname)
+                self.__log(slog, req_context, SagaLog.startTx, tname, saga_id)
+                ret = await self.run_action(slog, req_context, self.saga.actions[tname], payloads, apis, results,
+                                            deadline if rollback is None else None, saga_id, rollback is None)
+                self.__log(slog, req_context, SagaLog.endTx, tname, saga_id, {"result": ret,
+                                                                             "rollback": bool(rollback)})
+                results.update(ret)
+                if rollback is None:
+                    completed.append(tname)
+                tname = self.saga.actions[tname].next_state(results)
+            except ApiError as e:
+                self.__log(slog, req_context, SagaLog.failTx, tname, saga_id, {"error": str(e),
+                                                                              "status_code": e.status_code,
+                                                                              "error_name": type(e).__name__})
+                self.__log(slog, req_context, SagaLog.abortSaga, self.name, saga_id)
+                logger.debug("ApiError=" + str(e))
+                if rollback is not None:
+                    self.__log(slog, req_context, SagaLog.errorSaga, self.name, saga_id)
+                    raise SagaError(rollback, [e])
+                rollback = e
+                try:
+                    tname = self.saga.actions[tname].compensate(e.status_code, type(e).__name__)
+                except SagaException as ce:
+                    self.__log(slog, req_context, SagaLog.errorSaga, self.name, saga_id)
+                    raise SagaError(e, [ce])
+            except asyncio.CancelledError:
+                self.__log(slog, req_context, SagaLog.failTx, tname, saga_id, {"error": "cancelled"})
+                self.__log(slog, req_context, SagaLog.errorSaga, self.name, saga_id)
+                raise
+            except BaseException as e:
+                self.__log(slog, req_context, SagaLog.failTx, tname, saga_id, {"error": str(e)})
+                logger.debug("e=" + str(e))
+                self.__log(slog, req_context, SagaLog.errorSaga, self.name, saga_id)
+                raise SagaError(e, [])
+
+        if rollback:
+            self.saga.forget(req_context, completed, payloads)
+            self.__log(slog, req_context, SagaLog.rollbackSaga, self.name, saga_id)
+            raise SagaRollBack(rollback)
+
+        if tname is not True:
+            self.__log(slog, req_context, SagaLog.errorSaga, self.name, saga_id)
+            raise SagaException("saga reached fail state: " + tname)
+
+        self.__log(slog, req_context, SagaLog.commitSaga, self.name, saga_id)
+        return results
+
+    async def run_action(self, slog, req_context, action, payloads, apis, results, deadline, saga_id=None,
+                         idempotent=False):
+        """
+        Run one state, retrying it by its Retry policies while a retry can finish waiting before the deadline.
+        :param slog: SagaLog of the execution
+        :param req_context:
+        :param action: TaskAction
+        :param payloads:
+        :param apis:
+        :param results:
+        :param deadline: event loop time or None
+        :param saga_id:
+        :param idempotent: look up and record the state in the completion store
+        :return: dict the exec_api return value under the result path
+        """
+        store = None
+        key = None
+        if idempotent:
+            store = get_completion_store()
+        if store:
+            key = get_idempotency_key(req_context, self.name, action.name())
+        if key:
+            ret = store.get(key)
+            if ret is not None:
+                return ret
+        if isinstance(action, ChoiceAction):
+            return {}
+        attempts = {}
+        while True:
+            try:
+                ret = await self.act(req_context, action, payloads, apis, results, deadline)
+                if key:
+                    store.put(key, ret)
+                return ret
+            except ApiError as e:
+                index = action.retry(e.status_code, type(e).__name__)
+                if index is None:
+                    raise e
+                policy = action.retries()[index]
+                attempt = attempts.get(index, 0)
+                if attempt >= policy["max_attempts"]:
+                    raise e
+                delay = get_retry_delay(policy, attempt)
+                if deadline is not None and asyncio.get_event_loop().time() + delay >= deadline:
+                    raise e
+                attempts[index] = attempt + 1
+                self.__log(slog, req_context, SagaLog.retryTx, action.name(), saga_id,
+                           {"error": str(e), "status_code": e.status_code, "attempt": attempt + 1})
+                await asyncio.sleep(delay)
+
+    async def act(self, req_context, action, payloads, apis, results, deadline):
+        """
+        Run one state, cancelling it when its timeout passes.
+        :param req_context:
+        :param action: TaskAction
+        :param payloads:
+        :param apis:
+        :param results:
+        :param deadline: event loop time or None
+        :return: dict the exec_api return value under the result path
+        """
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - asyncio.get_event_loop().time()
+        timeout = get_timeout(action.timeout, remaining)
+        if timeout is None:
+            return await self.call(req_context, action, payloads, apis, results, None)
+        if timeout <= 0:
+            raise timeout_error(action.name())
+        try:
+            return await asyncio.wait_for(self.call(req_context, action, payloads, apis, results, timeout), timeout)
+        except asyncio.TimeoutError:
+            raise timeout_error(action.name())
+
+    async def call(self, req_context, action, payloads, apis, results, timeout):
+        api = ApiMngr(req_context).get_api_instance(action.api)
+        exec_api = apis[action.name()]
+        data = action.paths.input(results)
+        if timeout is not None and accepts_timeout(exec_api):
+            ret = exec_api(api, data, payloads[action.name()], timeout=timeout)
+        else:
+            ret = exec_api(api, data, payloads[action.name()])
+        if inspect.isawaitable(ret):
+            ret = await ret
+        return action.output(ret)
+
+    def __log(self, slog, req_context, saga_stage, name, saga_id, data=None):
+        slog.log(req_context, saga_stage, name, saga_id is not None, saga_id, data)
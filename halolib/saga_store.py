@@ -0,0 +1,366 @@
+from __future__ import print_function
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+from .exceptions import HaloError
+from .settingsx import settingsx
+
+settings = settingsx()
+
+logger = logging.getLogger(__name__)
+
+"""
+durable transaction log for sagas.
+every record is a dict of saga_id, seq, saga_name, stage, state, correlation_id, data (json text) and created (epoch ms).
+a saga is finished once a commitSaga or rollbackSaga record is written for it.
+a saga whose last record is a checkpointSaga waits for its caller to resume it and is not recovered.
+"""
+
+FINISHED_STAGES = ("commitSaga", "rollbackSaga")
+CHECKPOINT_STAGE = "checkpointSaga"
+
+
+class AbsSagaStore(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def append(self, records):
+        """
+
+        :param records: list of record dicts
+        """
+        pass
+
+    @abstractmethod
+    def get_records(self, saga_id):
+        """
+
+        :param saga_id:
+        :return: list of record dicts ordered by seq
+        """
+        pass
+
+    @abstractmethod
+    def get_unfinished(self, created_before):
+        """
+
+        :param created_before: epoch ms
+        :return: list of saga ids started before created_before, not finished and not stopped at a checkpoint
+        """
+        pass
+
+    def save_checkpoint(self, token, data):
+        """
+        checkpoints are kept as a single record under the token
+
+        :param token:
+        :param data: dict with the saga name and state
+        """
+        self.append([{"saga_id": token, "seq": 0, "saga_name": data["saga"], "stage": "checkpoint",
+                      "state": data["state"], "correlation_id": None, "data": to_data(data),
+                      "created": int(time.time() * 1000)}])
+
+    def load_checkpoint(self, token):
+        """
+
+        :param token:
+        :return: dict or None
+        """
+        records = self.get_records(token)
+        if not records:
+            return None
+        return from_data(records[0]["data"])
+
+
+class SqliteSagaStore(AbsSagaStore):
+    """
+    saga log in a local sqlite file, for local runs and tests
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS saga_log (saga_id TEXT, seq INTEGER, saga_name TEXT, "
+                                "stage TEXT, state TEXT, correlation_id TEXT, data TEXT, created INTEGER, "
+                                "PRIMARY KEY (saga_id, seq))")
+            self.__conn.commit()
+
+    def append(self, records):
+        rows = [(r["saga_id"], r["seq"], r["saga_name"], r["stage"], r["state"], r["correlation_id"], r["data"],
+                 r["created"]) for r in records]
+        with self.__lock:
+            self.__conn.executemany("INSERT INTO saga_log VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.__conn.commit()
+
+    def get_records(self, saga_id):
+        with self.__lock:
+            rows = self.__conn.execute("SELECT saga_id, seq, saga_name, stage, state, correlation_id, data, created "
+                                       "FROM saga_log WHERE saga_id = ? ORDER BY seq", (saga_id,)).fetchall()
+        keys = ("saga_id", "seq", "saga_name", "stage", "state", "correlation_id", "data", "created")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get_unfinished(self, created_before):
+        with self.__lock:
+            rows = self.__conn.execute("SELECT saga_id FROM saga_log s WHERE stage = 'startSaga' AND created < ? AND "
+                                       "saga_id NOT IN (SELECT saga_id FROM saga_log WHERE stage IN (?, ?)) AND "
+                                       "(SELECT stage FROM saga_log WHERE saga_id = s.saga_id ORDER BY seq DESC "
+                                       "LIMIT 1) != ? ORDER BY created",
+                                       (created_before,) + FINISHED_STAGES + (CHECKPOINT_STAGE,)).fetchall()
+        return [row[0] for row in rows]
+
+
+def get_saga_log_model(table_name, host=None):
+    """
+    pynamodb model of the saga log table
+
+    :param table_name:
+    :param host:
+    :return:
+    """
+    from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+    from .models import AbsModel
+
+    meta = {"table_name": table_name}
+    if host:
+        meta["host"] = host
+
+    class SagaLogModel(AbsModel):
+        Meta = type("Meta", (object,), meta)
+
+        saga_id = UnicodeAttribute(hash_key=True)
+        seq = NumberAttribute(range_key=True)
+        saga_name = UnicodeAttribute()
+        stage = UnicodeAttribute()
+        state = UnicodeAttribute()
+        correlation_id = UnicodeAttribute(null=True)
+        data = UnicodeAttribute(null=True)
+        created = NumberAttribute()
+
+    return SagaLogModel
+
+
+class DynamoSagaStore(AbsSagaStore):
+    """
+    saga log in a dynamodb table through AbsModel
+    """
+
+    keys = ("saga_id", "seq", "saga_name", "stage", "state", "correlation_id", "data", "created")
+
+    def __init__(self, table_name, host=None):
+        self.model = get_saga_log_model(table_name, host)
+        if not self.model.exists():
+            self.model.create_table(read_capacity_units=1, write_capacity_units=1, wait=True)
+
+    def append(self, records):
+        with self.model.batch_write() as batch:
+            for r in records:
+                item = self.model(**{key: r[key] for key in self.keys})
+                item.halo_request_id = item.get_idempotent_id(r["correlation_id"] or r["saga_id"])
+                batch.save(item)
+
+    def get_records(self, saga_id):
+        return [{key: getattr(item, key) for key in self.keys} for item in self.model.query(saga_id)]
+
+    def get_unfinished(self, created_before):
+        started = self.model.scan((self.model.stage == "startSaga") & (self.model.created < created_before))
+        ret = []
+        for item in started:
+            stages = [record.stage for record in self.model.query(item.saga_id)]
+            if not any(stage in FINISHED_STAGES for stage in stages) and stages[-1] != CHECKPOINT_STAGE:
+                ret.append(item.saga_id)
+        return ret
+
+
+store = None
+store_lock = threading.Lock()
+
+
+def get_saga_store():
+    """
+    the store set by SAGA_LOG_STORE: None for no durable log, "sqlite" (SAGA_LOG_DB_PATH) or "dynamodb" (SAGA_LOG_TABLE)
+
+    :return:
+    """
+    global store
+    if store is None:
+        with store_lock:
+            if store is None:
+                kind = settings.SAGA_LOG_STORE
+                if not kind:
+                    return None
+                if kind == "sqlite":
+                    store = SqliteSagaStore(settings.SAGA_LOG_DB_PATH)
+                elif kind == "dynamodb":
+                    store = DynamoSagaStore(settings.SAGA_LOG_TABLE, settings.DB_URL)
+                else:
+                    raise HaloError("unknown saga log store: " + str(kind))
+    return store
+
+
+def set_saga_store(saga_store):
+    """
+
+    :param saga_store: AbsSagaStore or None
+    """
+    global store
+    store = saga_store
+
+
+class AbsCompletionStore(object):
+    """
+    results of saga steps that completed, by idempotency key
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def get(self, key):
+        """
+
+        :param key:
+        :return: the recorded result or None
+        """
+        pass
+
+    @abstractmethod
+    def put(self, key, result):
+        """
+
+        :param key:
+        :param result: dict
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        """
+
+        :param key:
+        """
+        pass
+
+
+class LocalCompletionStore(AbsCompletionStore):
+    """
+    completions in process memory, for local runs and tests
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.__items = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__items.get(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.__items[key]
+                return None
+            return item[1]
+
+    def put(self, key, result):
+        with self.__lock:
+            self.__items[key] = (time.time() + self.ttl, result)
+
+    def delete(self, key):
+        with self.__lock:
+            self.__items.pop(key, None)
+
+
+class MemcacheCompletionStore(AbsCompletionStore):
+    """
+    completions in memcache, shared by all the lambdas of a service
+    """
+
+    def __init__(self, nodes, ttl):
+        """
+
+        :param nodes: list of "host:port"
+        :param ttl: seconds
+        """
+        from pymemcache.client.hash import HashClient
+        servers = []
+        for node in nodes:
+            host, port = node.rsplit(":", 1)
+            servers.append((host, int(port)))
+        self.client = HashClient(servers)
+        self.ttl = ttl
+
+    def get(self, key):
+        data = self.client.get(key)
+        if data is None:
+            return None
+        if isinstance(data, bytes):
+            data = data.decode()
+        return from_data(data)
+
+    def put(self, key, result):
+        self.client.set(key, to_data(result), expire=int(self.ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+completion_store = None
+
+
+def get_completion_store():
+    """
+    the store set by SAGA_IDEMPOTENCY_STORE: None for no idempotency, "local" or "memcache" (SAGA_MEMCACHE_NODES)
+
+    :return:
+    """
+    global completion_store
+    if completion_store is None:
+        with store_lock:
+            if completion_store is None:
+                kind = settings.SAGA_IDEMPOTENCY_STORE
+                if not kind:
+                    return None
+                ttl = settings.SAGA_IDEMPOTENCY_TTL or 24 * 60 * 60
+                if kind == "local":
+                    completion_store = LocalCompletionStore(ttl)
+                elif kind == "memcache":
+                    completion_store = MemcacheCompletionStore(settings.SAGA_MEMCACHE_NODES, ttl)
+                else:
+                    raise HaloError("unknown saga idempotency store: " + str(kind))
+    return completion_store
+
+
+def set_completion_store(store):
+    """
+
+    :param store: AbsCompletionStore or None
+    """
+    global completion_store
+    completion_store = store
+
+
+def to_data(data):
+    """
+
+    :param data:
+    :return:
+    """
+    if data is None:
+        return None
+    return json.dumps(data, default=str)
+
+
+def from_data(data):
+    """
+
+    :param data:
+    :return:
+    """
+    if data is None:
+        return None
+    return json.loads(data)
@@ -25,3 +25,26 @@ class settingsx(object):
         except RuntimeError as e:
             print("settingsx=" + name + " error:" + str(e))
             return None
+
+
+def bind_context(func):
+    """
+    flask keeps settings in the app context which is thread local.
+    bind func to the current app so settings can be read when it runs on another thread.
+
+    :param func:
+    :return:
+    """
+    global flx
+    if flx == False:
+        return func
+    try:
+        real_app = app._get_current_object()
+    except (RuntimeError, NameError):
+        return func
+
+    def wrapper(*args, **kwargs):
+        with real_app.app_context():
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -389,6 +389,70 @@ THRIFT_MAX_RETRY = 4
 
 HTTP_RETRY_SLEEP = 0.100  # in seconds = 100 ms
 
+API_LATENCY_SAMPLES = 1000  # call times kept per api class for the saga analyzer
+
+EVENT_DISPATCH_WORKERS = 2  # threads sending local events
+
+EVENT_QUEUE_SIZE = 1000  # local events waiting to be sent
+
+EVENT_QUEUE_TIMEOUT_IN_SC = 0.1  # wait for a free slot before send_event fails
+
+EVENT_SEND_TIMEOUT_IN_SC = 10  # post of a local event
+
+EVENT_DRAIN_TIMEOUT_IN_SC = 5  # time to send the queued events at exit
+
+EVENT_LOCAL_BACKEND = 'http'  # local events: 'http' posts to LOC_TABLE, 'bus' calls the registered handler in process
+
+EVENT_BATCH_SIZE = 10  # events per target an EventPublisher collects before it sends them
+
+EVENT_BATCH_WAIT_IN_SC = 1  # oldest collected event age that makes an EventPublisher send
+
+EVENT_BATCH_MAX_BYTES = 256 * 1024  # payload limit of an async lambda invoke
+
+EVENT_BATCH_WORKERS = 4  # parallel invokes of one batch
+
+EVENT_RECORD_WORKERS = 10  # records of an incoming batch processed at once
+
+EVENT_BATCH_MAX_ATTEMPTS = 3  # times the failed items of an incoming halo batch are run before the invoke fails
+
+EVENT_CODEC = 'json'  # event payload codec: 'json', 'msgpack', 'json+zlib' or 'msgpack+zlib'
+
+EVENT_CLAIM_CHECK_BYTES = 200 * 1024  # encoded events larger than this go to the blob store
+
+EVENT_BLOB_STORE = None  # claim-check blobs: None, 'local' or 's3'
+
+EVENT_BLOB_PATH = '/tmp/halo_event_blobs'
+
+EVENT_BLOB_BUCKET = None
+
+SAGA_MAX_WORKERS = 10  # max threads running saga branches at once
+
+SAGA_LOG_STORE = None  # durable saga log: None, 'sqlite' or 'dynamodb'
+
+SAGA_LOG_DB_PATH = '/tmp/saga_log.sqlite3'
+
+SAGA_LOG_TABLE = 'saga-log'
+
+SAGA_LOG_BATCH_SIZE = 10  # records per write to the durable saga log
+
+SAGA_RECOVERY_AGE_MS = 15 * 60 * 1000  # sagas unfinished for longer than this are recovered
+
+SAGA_CHECKPOINT_MS = 1000  # a saga checkpoints when less lambda time than this is left before a state
+
+SAGA_PARALLEL_COMPENSATION = False  # run the compensation chain concurrently instead of one state at a time
+
+SAGA_COMPENSATION_MAX_ATTEMPTS = 3  # retries of a failed compensation when run concurrently
+
+SAGA_COMPENSATION_RETRY_MS = 100  # wait before the first retry of a compensation, doubled on every retry
+
+SAGA_IDEMPOTENCY_STORE = None  # completed saga steps by idempotency key: None, 'local' or 'memcache'
+
+SAGA_IDEMPOTENCY_TTL = 24 * 60 * 60  # seconds a completed step is remembered
+
+SAGA_MEMCACHE_NODES = []  # "host:port" of the memcache nodes
+
+SAGA_HISTORY_SIZE = 100  # recent saga executions kept for the perf page
+
 FRONT_WEB = False
 
 FRONT_API = False
@@ -420,6 +484,9 @@ with open(file_path, 'r') as fi:
     LOC_TABLE = json.load(fi)
     print("loc_settings:" + str(LOC_TABLE))
 
+SAGA_CONFIG = {"test": os.path.join(file_dir, 'tests', 'saga.json')}
+SAGA_SCHEMA = os.path.join(file_dir, 'tests', 'schema.json')
+
 SSM_CONFIG = None
 if ENV_NAME == LOC:
     # from halolib.ssm import get_config as get_config
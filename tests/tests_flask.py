@@ -12,7 +12,7 @@ fake = Faker()
 
 from halolib.flask.utilx import Util, status
 from halolib.apis import ApiTest
-from halolib.exceptions import ApiError
+from halolib.exceptions import ApiError, HaloError
 from halolib.logs import log_json
 from halolib import saga
 from halolib.models import AbsModel
@@ -23,6 +23,81 @@ app = Flask(__name__)
 api = Api(app)
 app.config.from_object('settings')
 
+handled = []
+
+
+class DispatchHandler(object):
+    reusable = True
+
+    def do_event(self, event, context):
+        handled.append((type(self).__name__, id(self)))
+
+
+class OtherDispatchHandler(DispatchHandler):
+    reusable = False
+
+
+BOOKING = ["BookHotel", "BookFlight", "BookRental", "CancelHotel", "CancelFlight", "CancelRental"]
+
+
+def load_test_saga(file_name, edit=None, schema=False, name="test"):
+    """
+
+    :param file_name: saga definition in the tests dir
+    :param edit: function changing the States of the definition before it is loaded
+    :param schema: validate with schema.json
+    :param name:
+    :return:
+    """
+    with open(file_name) as f:
+        jsonx = json.load(f)
+    if edit:
+        edit(jsonx["States"])
+    schemax = None
+    if schema:
+        with open("schema.json") as f1:
+            schemax = json.load(f1)
+    return saga.load_saga(name, jsonx, schemax)
+
+
+def booking(done=None, names=BOOKING, **overrides):
+    """
+    payloads and apis of the booking sagas. every api returns {"id": <state>} and, with done, appends the state to it
+
+    :param done: list
+    :param names: states
+    :param overrides: state -> exec_api replacing the default one
+    :return: (payloads, apis)
+    """
+
+    def book(api, results, payload):
+        if done is not None:
+            done.append(payload["name"])
+        return {"id": payload["name"]}
+
+    payloads = {name: {"name": name} for name in names}
+    apis = {name: book for name in names}
+    apis.update(overrides)
+    return payloads, apis
+
+
+def fail_api(message, done=None):
+    """
+
+    :param message:
+    :param done: list the failing state is appended to
+    :return: exec_api raising an ApiError with status 503
+    """
+
+    def fail(api, results, payload):
+        if done is not None:
+            done.append(payload["name"])
+        err = ApiError(message)
+        err.status_code = 503
+        raise err
+
+    return fail
+
 
 class TestUserDetailTestCase(unittest.TestCase):
     """
@@ -57,6 +132,117 @@ class TestUserDetailTestCase(unittest.TestCase):
             except ApiError as e:
                 eq_(e.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_bulkhead_fail_fast(self):
+        from halolib.apis import Bulkhead
+        from halolib.exceptions import BulkheadFullError
+        bulkhead = Bulkhead("test", 1)
+        bulkhead.acquire()
+        flag = False
+        try:
+            bulkhead.acquire()
+        except BulkheadFullError as e:
+            flag = True
+            eq_(e.status_code, 503)
+        bulkhead.release()
+        eq_(flag, True)
+        eq_(bulkhead.get_stats(), {"max_concurrent": 1, "active": 0, "rejected": 1})
+
+    def test_api_bulkhead_config(self):
+        from halolib.apis import get_bulkhead_stats
+        with app.test_request_context(method='GET', path='/?a=b'):
+            api = ApiTest(Util.get_req_context(request))
+            eq_(api.bulkhead.name, "google")
+            eq_(get_bulkhead_stats()["google"]["max_concurrent"], 10)
+
+    def run_batcher(self, batch, reply, calls, status_code=200):
+        """
+        run calls(batcher, sent) against a batch api answering reply(items)
+
+        :param batch: the "batch" entry of the api config
+        :param status_code: of the batch api response
+
+        :return: list of the item lists the api got
+        """
+        from halolib.apis import AbsBaseApi, ApiBatcher
+        sent = []
+
+        class Response(object):
+            def __init__(self, value):
+                self.value = value
+                self.status_code = status_code
+
+            def json(self):
+                return self.value
+
+        class BatchApi(AbsBaseApi):
+            name = "Batch"
+
+            def process(self, method, url, timeout, data=None, headers=None):
+                items = json.loads(data)
+                sent.append(items)
+                return Response(reply(items))
+
+        api_config = app.config.get("API_CONFIG")
+        app.config["API_CONFIG"] = dict(api_config or {}, Batch={"url": "http://batch", "type": "service",
+                                                                 "batch": batch})
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                calls(ApiBatcher(BatchApi), sent)
+        finally:
+            app.config["API_CONFIG"] = api_config
+        return sent
+
+    def test_api_batcher_flush(self):
+        results = []
+
+        def calls(batcher, sent):
+            futures = [batcher.submit({"x-correlation-id": str(i)}, {"id": i}) for i in range(5)]
+            eq_(len(sent), 1)
+            results.extend(future.result(5) for future in futures)
+
+        sent = self.run_batcher({"url": "http://batch", "max_size": 3, "window_ms": 20},
+                                lambda items: [item["id"] * 10 for item in items], calls)
+        # three go when the batch is full, the last two when the window ends
+        eq_([[item["id"] for item in items] for items in sent], [[0, 1, 2], [3, 4]])
+        eq_(results, [0, 10, 20, 30, 40])
+
+    def test_api_batcher_results(self):
+        ret = {}
+
+        def calls(batcher, sent):
+            ret["ordered"] = batcher.call_many({}, [{"id": 1}, {"id": 2}])
+
+        self.run_batcher({"url": "http://batch"}, lambda items: [item["id"] + 1 for item in items], calls)
+        eq_(ret["ordered"], [2, 3])
+
+        def keyed(batcher, sent):
+            ret["keyed"] = batcher.call_many({}, [{"id": 1}, {"id": 2}, {"id": 3}])
+
+        # the keyed api answers out of order
+        self.run_batcher({"url": "http://batch", "key": "id"},
+                         lambda items: {str(item["id"]): item["id"] * 2 for item in reversed(items)}, keyed)
+        eq_(ret["keyed"], [2, 4, 6])
+
+    def test_api_batcher_failure(self):
+        errors = []
+
+        def calls(batcher, sent):
+            futures = [batcher.submit({}, {"id": i}) for i in range(3)]
+            batcher.flush()
+            for future in futures:
+                try:
+                    future.result(5)
+                except ApiError as e:
+                    errors.append(e.status_code)
+
+        # one result short for three items fails every item of the batch
+        self.run_batcher({"url": "http://batch"}, lambda items: [1, 2], calls)
+        eq_(errors, [500, 500, 500])
+        # an error response fails every item of the batch with its status code
+        del errors[:]
+        self.run_batcher({"url": "http://batch"}, lambda items: [{"error": "busy"}] * len(items), calls, 503)
+        eq_(errors, [503, 503, 503])
+
     def test_send_event(self):
         with app.test_request_context(method='GET', path='/?a=b'):
             from halolib.events import AbsBaseEvent
@@ -71,6 +257,224 @@ class TestUserDetailTestCase(unittest.TestCase):
             print("event response " + str(response))
             eq_(response, 'sent event')
 
+    def test_local_event_bus(self):
+        from halolib.events import AbsBaseEvent, AbsBaseHandler, register_local_handler, get_event_dispatcher
+        got = []
+
+        class BusEvent(AbsBaseEvent):
+            target_service = 'bus1'
+            key_name = 'def'
+            key_val = '456'
+
+        class BusHandler(AbsBaseHandler):
+            def process_event(self, event, context):
+                got.append(event)
+
+        register_local_handler('bus1', BusHandler())
+        config = {key: app.config.get(key) for key in ("SERVER_LOCAL", "EVENT_LOCAL_BACKEND")}
+        app.config.update({"SERVER_LOCAL": True, "EVENT_LOCAL_BACKEND": "bus"})
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                ctx = Util.get_req_context(request)
+                eq_(BusEvent().send_event({"name": "david"}, ctx=ctx), 'sent event')
+                eq_(get_event_dispatcher().drain(5), True)
+        finally:
+            app.config.update(config)
+        eq_(got[0]["name"], "david")
+        eq_(got[0]["def"], "456")
+        eq_(got[0]["x-correlation-id"], ctx["x-correlation-id"])
+
+    def test_event_codec(self):
+        import shutil
+        import tempfile
+        import zlib
+        from halolib.event_codec import encode_event, decode_event, LocalBlobStore, set_blob_store, ENVELOPE_KEY
+        message = {"name": "david", "items": ["x" * 100] * 20}
+        path = tempfile.mkdtemp()
+        config = {key: app.config.get(key) for key in ("EVENT_CODEC", "EVENT_CLAIM_CHECK_BYTES")}
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                app.config.update({"EVENT_CODEC": "json", "EVENT_CLAIM_CHECK_BYTES": 10000})
+                payload = encode_event(message)
+                eq_(json.loads(payload), message)
+                app.config["EVENT_CLAIM_CHECK_BYTES"] = len(payload) - 1
+                set_blob_store(LocalBlobStore(path))
+                assert "ref" in json.loads(encode_event(message))[ENVELOPE_KEY]
+                set_blob_store(None)
+                app.config.update({"EVENT_CODEC": "json+zlib", "EVENT_CLAIM_CHECK_BYTES": 10000})
+                event = json.loads(encode_event(message))
+                eq_(event[ENVELOPE_KEY]["codec"], "json+zlib")
+                assert len(event[ENVELOPE_KEY]["data"]) < len(json.dumps(message))
+                eq_(decode_event(event), message)
+                app.config["EVENT_CLAIM_CHECK_BYTES"] = 10
+                shutil.rmtree(path)
+                set_blob_store(LocalBlobStore(path))
+                event = json.loads(encode_event(message))
+                assert "ref" in event[ENVELOPE_KEY]
+                eq_(os.listdir(path), [event[ENVELOPE_KEY]["ref"]])
+                eq_(decode_event(event), message)
+                # compressed to less than the limit, but over it once base64 in the json envelope
+                message = {"items": [os.urandom(30).hex() for _ in range(20)]}
+                app.config["EVENT_CLAIM_CHECK_BYTES"] = 900
+                assert len(zlib.compress(json.dumps(message).encode())) < 900
+                event = json.loads(encode_event(message))
+                assert "ref" in event[ENVELOPE_KEY]
+                eq_(decode_event(event), message)
+                for ref in ["../" + event[ENVELOPE_KEY]["ref"], "/etc/passwd", ".."]:
+                    try:
+                        decode_event({ENVELOPE_KEY: {"codec": "json+zlib", "ref": ref}})
+                        raise AssertionError("blob key accepted: " + ref)
+                    except HaloError:
+                        pass
+        finally:
+            set_blob_store(None)
+            shutil.rmtree(path)
+            app.config.update(config)
+
+    def test_event_dispatcher(self):
+        import threading
+        from halolib.events import EventDispatcher, EventQueueFullException
+        dispatcher = EventDispatcher(1, 1)
+        gate = threading.Event()
+        sent = []
+
+        def send(msg):
+            gate.wait(5)
+            sent.append(msg)
+
+        dispatcher.submit(send, 1)
+        eq_(dispatcher.drain(0.05), False)
+        dispatcher.submit(send, 2)
+        flag = False
+        try:
+            dispatcher.submit(send, 3)
+        except EventQueueFullException:
+            flag = True
+        eq_(flag, True)
+        gate.set()
+        eq_(dispatcher.drain(5), True)
+        eq_(sent, [1, 2])
+        stats = dispatcher.get_stats()
+        eq_((stats["dispatched"], stats["rejected"], stats["queue_depth"]), (2, 1, 0))
+
+    def test_event_batch(self):
+        import threading
+        from halolib.events import AbsBaseEvent, AbsMainHandler, EventPublisher, get_batch_payloads, BATCH_KEY, \
+            get_event_dispatcher
+        sent = []
+
+        class BatchEvent(AbsBaseEvent):
+            target_service = 'func1'
+            key_name = 'def'
+            key_val = '456'
+
+            def send_batch(self, messages, ctx=None):
+                sent.append([m["name"] for m in messages])
+                return ["sent"]
+
+        with app.test_request_context(method='GET', path='/?a=b'):
+            with EventPublisher(max_size=2, max_wait=0) as publisher:
+                for name in ["a", "b", "c"]:
+                    publisher.add(BatchEvent(), {"name": name})
+                eq_(sent, [["a", "b"]])
+        eq_(sent, [["a", "b"], ["c"]])
+        payloads = get_batch_payloads([{"name": "x" * 40} for _ in range(5)], 140)
+        eq_([len(json.loads(p)[BATCH_KEY]) for p in payloads], [2, 2, 1])
+        # a batch filled exactly to max_bytes, the next message starts a new one
+        message = {"name": "x" * 40}
+        full = len(json.dumps({BATCH_KEY: [message] * 3}))
+        eq_([len(p) for p in get_batch_payloads([message] * 4, full)], [full, len(json.dumps({BATCH_KEY: [message]}))])
+        eq_([len(json.loads(p)[BATCH_KEY]) for p in get_batch_payloads([message] * 4, full - 1)], [2, 2])
+
+        got = []
+
+        class Handler(AbsMainHandler):
+            def process_event(self, event, context):
+                got.append(event["name"])
+
+        Handler().get_event(json.loads(payloads[0]), None)
+        eq_(len(got), 2)
+
+        class FailingHandler(AbsMainHandler):
+            def process_event(self, event, context):
+                with lock:
+                    got.append(event["name"])
+                    if event["name"] == "c" or got.count("b") == 1 and event["name"] == "b":
+                        raise ApiError("failed")
+
+        # only the failed items are run again, in batches of their own, up to EVENT_BATCH_MAX_ATTEMPTS times
+        lock = threading.Lock()
+        del got[:]
+        dispatcher = get_event_dispatcher()
+        failed = dispatcher.get_stats()["failed"]
+        with app.test_request_context(method='GET', path='/?a=b'):
+            FailingHandler().get_event({BATCH_KEY: [{"name": "a"}, {"name": "b"}, {"name": "c"}]}, None)
+            dispatcher.drain(5)
+        max_attempts = app.config.get("EVENT_BATCH_MAX_ATTEMPTS") or 3
+        eq_(sorted(got), ["a", "b", "b"] + ["c"] * max_attempts)
+        eq_(dispatcher.get_stats()["failed"], failed + 1)
+
+        class NotificationHandler(AbsMainHandler):
+            def process_event(self, event, context):
+                got.append(event)
+
+        # an sns or s3 notification is a single event
+        del got[:]
+        notification = {"Records": [{"eventSource": "aws:s3", "s3": {}}]}
+        eq_(NotificationHandler().get_event(notification, None), None)
+        eq_(got, [notification])
+
+    def test_event_dispatch_index(self):
+        from halolib.events import AbsMainHandler
+
+        class MainHandler(AbsMainHandler):
+            keys = ["a", "b"]
+            vals = {"a": "1", "b": "2"}
+            classes = {"a": "DispatchHandler", "b": "OtherDispatchHandler"}
+
+        handler = MainHandler()
+        mixin_handler = app.config.get("MIXIN_HANDLER")
+        app.config["MIXIN_HANDLER"] = __name__
+        del handled[:]
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                for _ in range(2):
+                    handler.process_event({"b": "2", "a": "1", "c": {"x": 1}}, None)
+                handler.process_event({"a": "2", "b": ["2"]}, None)
+        finally:
+            app.config["MIXIN_HANDLER"] = mixin_handler
+        eq_([name for name, _ in handled], ["DispatchHandler", "OtherDispatchHandler"] * 2)
+        eq_(handled[0][1], handled[2][1])
+
+    def test_event_batch_records(self):
+        import base64
+        import threading
+        from halolib.events import AbsMainHandler
+        done = []
+        lock = threading.Lock()
+
+        class MainHandler(AbsMainHandler):
+            partition_key = "order"
+
+            def process_event(self, event, context):
+                if event["n"] == 2:
+                    raise ApiError("failed")
+                with lock:
+                    done.append((event["order"], event["n"]))
+
+        records = [{"messageId": "m%d" % n, "eventSource": "aws:sqs", "body": json.dumps({"order": order, "n": n})}
+                   for n, order in enumerate(["a", "b", "a", "b", "a"])]
+        with app.test_request_context(method='GET', path='/?a=b'):
+            ret = MainHandler().get_event({"Records": records}, None)
+            eq_(sorted(item["itemIdentifier"] for item in ret["batchItemFailures"]), ["m2", "m4"])
+            eq_(sorted(done), [("a", 0), ("b", 1), ("b", 3)])
+            eq_([n for order, n in done if order == "b"], [1, 3])
+            data = base64.b64encode(json.dumps({"order": "c", "n": 5}).encode()).decode()
+            ret = MainHandler().get_event({"Records": [{"eventSource": "aws:kinesis", "kinesis": {
+                "sequenceNumber": "7", "partitionKey": "c", "data": data}}]}, None)
+            eq_(ret["batchItemFailures"], [])
+            eq_(done[-1], ("c", 5))
+
     def test_system_debug_enabled(self):
         with app.test_request_context(method='GET', path='/?a=b'):
             os.environ['DEBUG_LOG'] = 'true'
@@ -197,6 +601,639 @@ class TestUserDetailTestCase(unittest.TestCase):
         sagax = saga.load_saga("test", jsonx, schema)
         eq_(len(sagax.actions), 6)
 
+    def test_load_saga_no_result_path(self):
+        with open("saga.json") as f:
+            jsonx = json.load(f)
+        del jsonx["States"]["BookFlight"]["ResultPath"]
+        try:
+            saga.build_saga("test", jsonx)
+            assert False
+        except HaloError as e:
+            eq_(str(e), "can not build saga. No ResultPath in BookFlight")
+
+        def null_result_path(states):
+            states["BookFlight"]["ResultPath"] = None
+
+        sagax = load_test_saga("saga.json", null_result_path, schema=True)
+        payloads, apis = booking()
+        with app.test_request_context(method='GET', path='/?a=b'):
+            ret = sagax.execute(Util.get_req_context(request), payloads, apis)
+        eq_(sorted(ret.keys()), ["$.BookHotelResult", "$.BookRentalResult"])
+
+    def test_get_saga_cached(self):
+        with app.test_request_context(method='GET', path='/?a=b'):
+            sagax = saga.get_saga("test")
+            eq_(len(sagax.actions), 6)
+            eq_(saga.get_saga("test") is sagax, True)
+
+    def test_load_saga_evicts_old_definition(self):
+        first = load_test_saga("saga.json", name="evict")
+        eq_(load_test_saga("saga.json", name="evict") is first, True)
+        second = load_test_saga("saga_choice.json", name="evict")
+        eq_([val for key, val in saga.sagas.items() if key.startswith("evict:")], [second])
+
+    def test_load_parallel_saga(self):
+        sagax = load_test_saga("saga_parallel.json", schema=True)
+        eq_(len(sagax.actions), 1)
+        eq_(len(sagax.actions["BookTrip"].branches), 3)
+
+    def test_parallel_saga_compensates_completed_branches(self):
+        sagax = load_test_saga("saga_parallel.json", schema=True)
+        done = []
+        payloads, apis = booking(done, BookFlight=fail_api("no flight"))
+        with app.test_request_context(method='GET', path='/?a=b'):
+            try:
+                sagax.execute(Util.get_req_context(request), payloads, apis)
+            except saga.SagaRollBack as e:
+                done.append("rollback")
+        eq_(sorted(done), ["BookHotel", "BookRental", "CancelFlight", "CancelHotel", "CancelRental", "rollback"])
+
+    def test_map_saga_keeps_item_order(self):
+        sagax = load_test_saga("saga_map.json", schema=True)
+
+        def reserve(api, results, payload):
+            return {"sku": payload["sku"]}
+
+        payloads = {"ReserveItems": {"items": [{"sku": str(i)} for i in range(5)]}}
+        apis = {"ReserveItem": reserve, "ReleaseItem": reserve}
+        with app.test_request_context(method='GET', path='/?a=b'):
+            ret = sagax.execute(Util.get_req_context(request), payloads, apis)
+        eq_([item["$.ReserveItemResult"]["sku"] for item in ret["$.ReserveItemsResult"]], ["0", "1", "2", "3", "4"])
+
+    def test_saga_recovery(self):
+        import subprocess
+        import sys
+        import tempfile
+        import time
+        from halolib.saga_store import SqliteSagaStore, set_saga_store
+        # the saga runs in another process that dies in BookRental, as a lambda killed in the middle of a saga
+        script = "\n".join([
+            "import json, os, sys",
+            "from flask import Flask",
+            "from halolib import saga",
+            "app = Flask(__name__)",
+            "app.config.update(json.loads(sys.argv[2]), SAGA_LOG_STORE='sqlite', SAGA_LOG_DB_PATH=sys.argv[1])",
+            "def book(api, results, payload):",
+            "    return {'id': payload['name']}",
+            "def crash(api, results, payload):",
+            "    os._exit(3)",
+            "names = %r" % BOOKING,
+            "apis = dict({name: book for name in names}, BookRental=crash)",
+            "with app.test_request_context('/'), open('saga.json') as f:",
+            "    saga.load_saga('test', json.load(f), None).execute({'x-correlation-id': 'crash'},",
+            "                                                      {name: {'name': name} for name in names}, apis)"])
+        path = tempfile.mktemp(suffix=".sqlite3")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        config = json.dumps({"API_CONFIG": app.config.get("API_CONFIG")})
+        try:
+            eq_(subprocess.call([sys.executable, "-c", script, path, config], env=env), 3)
+            store = SqliteSagaStore(path)
+            saga_id = store.get_unfinished(int(time.time() * 1000) + 1000)[0]
+            eq_([(record["stage"], record["state"]) for record in store.get_records(saga_id)][-2:],
+                [("endTx", "BookFlight"), ("startTx", "BookRental")])
+            sagax = load_test_saga("saga.json")
+            done = []
+            payloads, apis = booking(done)
+            set_saga_store(store)
+            with app.test_request_context(method='GET', path='/?a=b'):
+                ret = saga.SagaRecovery({"test": apis}, sagas={"test": sagax}, age_ms=-1000).run()
+        finally:
+            set_saga_store(None)
+            if os.path.exists(path):
+                os.remove(path)
+        eq_(list(ret.values()), ["rollback"])
+        eq_(done, ["CancelRental", "CancelFlight", "CancelHotel"])
+
+    def run_checkpoint(self, check):
+        """
+        run the booking saga with a lambda context that is out of time after BookFlight and
+        call check(sagax, req_context, payloads, apis, checkpoint, done)
+        """
+
+        class LambdaContext(object):
+            left = 1700
+
+            def get_remaining_time_in_millis(self):
+                return self.left
+
+        context = LambdaContext()
+        sagax = load_test_saga("saga.json")
+        done = []
+
+        def book(api, results, payload):
+            context.left = context.left - 400
+            done.append(payload["name"])
+            return {"id": payload["name"]}
+
+        payloads, apis = booking(done)
+        apis = {name: book for name in apis}
+        secret_key = app.config.get("SECRET_KEY")
+        app.config["SECRET_KEY"] = secret_key or "test-key"
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                ret = sagax.execute(req_context, payloads, apis, context=context)
+                eq_(ret.state, "BookRental")
+                check(sagax, req_context, payloads, apis, ret, done)
+        finally:
+            app.config["SECRET_KEY"] = secret_key
+
+    def test_saga_checkpoint(self):
+        import base64
+
+        def check(sagax, req_context, payloads, apis, checkpoint, done):
+            payload, signature = checkpoint.token[len(saga.INLINE_TOKEN):].split(".")
+            data = json.loads(base64.urlsafe_b64decode(payload.encode()).decode())
+            data["state"] = True
+            forged = base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+            try:
+                sagax.execute(req_context, payloads, apis, token=saga.INLINE_TOKEN + forged + "." + signature)
+                assert False
+            except saga.SagaException:
+                pass
+            ret = sagax.execute(req_context, payloads, apis, token=checkpoint.token)
+            eq_(done, ["BookHotel", "BookFlight", "BookRental"])
+            eq_(sorted(ret.keys()), ["$.BookFlightResult", "$.BookHotelResult", "$.BookRentalResult"])
+
+        self.run_checkpoint(check)
+
+    def test_saga_checkpoint_finished(self):
+        import time
+        from halolib.saga_store import SqliteSagaStore, set_saga_store
+
+        def check(sagax, req_context, payloads, apis, checkpoint, done):
+            # a saga waiting at a checkpoint is not for recovery
+            eq_(store.get_unfinished(int(time.time() * 1000) + 1000), [])
+            sagax.execute(req_context, payloads, apis, token=checkpoint.token)
+            try:
+                sagax.execute(req_context, payloads, apis, token=checkpoint.token)
+                assert False
+            except saga.SagaException as e:
+                assert "already finished" in str(e)
+            eq_(done, ["BookHotel", "BookFlight", "BookRental"])
+
+        store = SqliteSagaStore(":memory:")
+        set_saga_store(store)
+        try:
+            self.run_checkpoint(check)
+        finally:
+            set_saga_store(None)
+
+    def test_saga_no_catch(self):
+        import asyncio
+        from halolib.saga_async import AsyncSaga
+        from halolib.saga_store import SqliteSagaStore, set_saga_store
+        stages = []
+
+        class Store(SqliteSagaStore):
+            def append(self, records):
+                stages.extend(record["stage"] for record in records)
+                super(Store, self).append(records)
+
+        def no_catch(states):
+            del states["BookFlight"]["Catch"]
+
+        sagax = load_test_saga("saga.json", no_catch)
+        payloads, apis = booking(BookFlight=fail_api("no flight"))
+        set_saga_store(Store(":memory:"))
+        loop = asyncio.new_event_loop()
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                for run in [lambda: sagax.execute(req_context, payloads, apis),
+                            lambda: loop.run_until_complete(AsyncSaga(sagax).execute(req_context, payloads, apis))]:
+                    del stages[:]
+                    try:
+                        run()
+                        assert False
+                    except saga.SagaError as e:
+                        eq_(str(e.args[0]), "no flight")
+                    eq_(stages[-3:], ["failTx", "abortSaga", "errorSaga"])
+                    eq_(saga.get_saga_history()["recent"][0]["outcome"], "error")
+        finally:
+            loop.close()
+            set_saga_store(None)
+        eq_(sagax.slog._SagaLog__buffers, {})
+
+    def test_saga_retry(self):
+        def retry(states):
+            states["BookFlight"]["Retry"] = [{"ErrorEquals": ["503"], "IntervalSeconds": 0.01, "MaxAttempts": 2,
+                                              "BackoffRate": 2.0}]
+
+        sagax = load_test_saga("saga.json", retry, schema=True)
+        done = []
+
+        def book_busy(api, results, payload):
+            done.append(payload["name"])
+            if done.count(payload["name"]) < 3:
+                err = ApiError("busy")
+                err.status_code = 503
+                raise err
+            return {"id": payload["name"]}
+
+        payloads, apis = booking(done, BookFlight=book_busy)
+        with app.test_request_context(method='GET', path='/?a=b'):
+            sagax.execute(Util.get_req_context(request), payloads, apis)
+        eq_(done, ["BookHotel", "BookFlight", "BookFlight", "BookFlight", "BookRental"])
+
+    def test_saga_state_timeout(self):
+        import time
+
+        def timeout(states):
+            states["BookFlight"]["TimeoutSeconds"] = 0.2
+
+        sagax = load_test_saga("saga.json", timeout)
+        done = []
+        timeouts = []
+
+        def book_slow(api, results, payload, timeout):
+            timeouts.append(timeout)
+            time.sleep(1)
+            return {"id": payload["name"]}
+
+        payloads, apis = booking(done, BookFlight=book_slow)
+        with app.test_request_context(method='GET', path='/?a=b'):
+            try:
+                sagax.execute(Util.get_req_context(request), payloads, apis)
+                assert False
+            except saga.SagaRollBack as e:
+                eq_(e.args[0].status_code, "States.Timeout")
+        eq_(timeouts, [0.2])
+        eq_(done, ["BookHotel", "CancelFlight", "CancelHotel"])
+
+    def test_saga_compensation_deadline(self):
+        import time
+        checkpoint_ms = app.config.get("SAGA_CHECKPOINT_MS") or saga.DEFAULT_CHECKPOINT_MS
+
+        class LambdaContext(object):
+            left = checkpoint_ms + 5000
+
+            def get_remaining_time_in_millis(self):
+                return self.left
+
+        def timeouts(states):
+            states["CancelRental"]["TimeoutSeconds"] = 1
+
+        context = LambdaContext()
+        sagax = load_test_saga("saga.json", timeouts)
+        done = []
+        no_car = fail_api("no car", done)
+
+        def late(api, results, payload):
+            # the saga is out of time when its compensation starts
+            context.left = checkpoint_ms
+            no_car(api, results, payload)
+
+        payloads, apis = booking(done, BookRental=late)
+        cancel = apis["CancelRental"]
+
+        def slow_cancel(api, results, payload):
+            time.sleep(0.05)
+            return cancel(api, results, payload)
+
+        apis["CancelRental"] = slow_cancel
+        with app.test_request_context(method='GET', path='/?a=b'):
+            try:
+                sagax.execute(Util.get_req_context(request), payloads, apis, context=context)
+                assert False
+            except saga.SagaRollBack as e:
+                eq_(str(e.args[0]), "no car")
+        eq_(done, ["BookHotel", "BookFlight", "BookRental", "CancelRental", "CancelFlight", "CancelHotel"])
+
+    def test_saga_timeout_threads(self):
+        import threading
+
+        class LambdaContext(object):
+            def get_remaining_time_in_millis(self):
+                return 60000
+
+        def timeouts(states):
+            states["BookHotel"]["TimeoutSeconds"] = 1
+            states["BookFlight"]["TimeoutSeconds"] = 0.05
+
+        sagax = load_test_saga("saga.json", timeouts)
+        gate = threading.Event()
+        threads = {}
+
+        def stuck(api, results, payload):
+            gate.wait(10)
+            return {}
+
+        def book(api, results, payload):
+            threads[payload["name"]] = threading.current_thread()
+            return {"id": payload["name"]}
+
+        payloads, apis = booking()
+        apis = {name: book for name in apis}
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                # calls abandoned on a slow api hold no worker the next sagas wait for
+                for _ in range((app.config.get("SAGA_MAX_WORKERS") or 10) + 1):
+                    try:
+                        sagax.execute(req_context, payloads, dict(apis, BookFlight=stuck))
+                        assert False
+                    except saga.SagaRollBack as e:
+                        eq_(e.args[0].status_code, "States.Timeout")
+                sagax.execute(req_context, payloads, apis, context=LambdaContext())
+        finally:
+            gate.set()
+        # only a state with TimeoutSeconds leaves the saga thread
+        assert threads["BookHotel"] is not threading.current_thread()
+        assert threads["BookRental"] is threading.current_thread()
+
+    def test_saga_parallel_compensation(self):
+        sagax = load_test_saga("saga.json")
+        done = []
+
+        def cancel_flaky(api, results, payload):
+            done.append(payload["name"])
+            if done.count(payload["name"]) < 2:
+                raise ApiError("busy")
+            return {"id": payload["name"]}
+
+        payloads, apis = booking(done, BookRental=fail_api("no car"), CancelFlight=cancel_flaky)
+        config = {key: app.config.get(key) for key in ("SAGA_PARALLEL_COMPENSATION", "SAGA_COMPENSATION_RETRY_MS")}
+        app.config["SAGA_PARALLEL_COMPENSATION"] = True
+        app.config["SAGA_COMPENSATION_RETRY_MS"] = 1
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                try:
+                    sagax.execute(Util.get_req_context(request), payloads, apis)
+                    assert False
+                except saga.SagaRollBack:
+                    done.append("rollback")
+        finally:
+            app.config.update(config)
+        eq_(sorted(done), ["BookFlight", "BookHotel", "CancelFlight", "CancelFlight", "CancelHotel", "CancelRental",
+                           "rollback"])
+
+    def test_saga_benchmark(self):
+        from halolib.apis import register_api
+        from benchmarks.bench_saga import StubApi, run_scenario
+        register_api("Stub", StubApi)
+        with app.test_request_context(method='GET', path='/?a=b'):
+            ret = run_scenario(3, 2, 0.5, 0, 10)
+        eq_(ret["outcomes"]["commit"] + ret["outcomes"]["rollback"], 10)
+        assert ret["steps"] >= 10
+        assert ret["engine_us_per_step"] > 0
+
+    def test_saga_trace(self):
+        import logging
+        sagax = load_test_saga("saga.json")
+        summaries = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                if record.getMessage().startswith("SagaTrace"):
+                    summaries.append(record.params)
+
+        payloads, apis = booking(BookRental=fail_api("no car"))
+        handler = Handler()
+        logger = logging.getLogger("halolib.saga")
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                try:
+                    sagax.execute(Util.get_req_context(request), payloads, apis)
+                except saga.SagaRollBack:
+                    pass
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        eq_(len(summaries), 1)
+        eq_(summaries[0]["outcome"], "rollback")
+        eq_([(span["state"], span["outcome"]) for span in summaries[0]["spans"]][:3],
+            [("BookHotel", "ok"), ("BookFlight", "ok"), ("BookRental", "error")])
+        eq_(summaries[0]["compensation_path"], ["CancelRental", "CancelFlight", "CancelHotel"])
+
+    def test_saga_history(self):
+        sagax = load_test_saga("saga.json", name="history")
+        payloads, apis = booking()
+        with app.test_request_context(method='GET', path='/?a=b'):
+            for _ in range(3):
+                sagax.execute(Util.get_req_context(request), payloads, apis)
+        history = saga.get_saga_history()
+        eq_(history["counters"]["history"]["commit"], 3)
+        last = history["recent"][0]
+        eq_(last["saga"], "history")
+        eq_(last["outcome"], "commit")
+        eq_([state[0] for state in last["states"]], ["BookHotel", "BookFlight", "BookRental"])
+        assert len(history["recent"]) <= app.config.get("SAGA_HISTORY_SIZE", 100)
+
+    def test_saga_history_branches(self):
+        sagax = load_test_saga("saga_map.json", name="history_map")
+
+        def reserve(api, results, payload):
+            return {"sku": payload["sku"]}
+
+        payloads = {"ReserveItems": {"items": [{"sku": str(i)} for i in range(3)]}}
+        apis = {"ReserveItem": reserve, "ReleaseItem": reserve}
+        with app.test_request_context(method='GET', path='/?a=b'):
+            sagax.execute(Util.get_req_context(request), payloads, apis)
+        history = saga.get_saga_history()
+        # the iterations are spans of the saga that runs the Map state, not sagas of their own
+        eq_([name for name in history["counters"] if name.startswith("history_map")], ["history_map"])
+        last = history["recent"][0]
+        eq_(last["saga"], "history_map")
+        eq_(sorted(state[0] for state in last["states"]),
+            ["ReserveItems", "ReserveItems/0/ReserveItem", "ReserveItems/1/ReserveItem", "ReserveItems/2/ReserveItem"])
+
+    def test_saga_idempotency(self):
+        from halolib.saga_store import LocalCompletionStore, set_completion_store
+        sagax = load_test_saga("saga.json")
+        done = []
+        payloads, apis = booking(done)
+        book = apis["BookRental"]
+        set_completion_store(LocalCompletionStore(60))
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                first = sagax.execute(req_context, payloads, apis)
+                second = sagax.execute(req_context, payloads, apis)
+                eq_(second, first)
+                eq_(done, ["BookHotel", "BookFlight", "BookRental"])
+                req_context = dict(req_context)
+                req_context["x-correlation-id"] = req_context["x-correlation-id"] + "-2"
+                del done[:]
+                apis["BookRental"] = fail_api("no car", done)
+                try:
+                    sagax.execute(req_context, payloads, apis)
+                except saga.SagaRollBack:
+                    pass
+                apis["BookRental"] = book
+                sagax.execute(req_context, payloads, apis)
+        finally:
+            set_completion_store(None)
+        eq_(done, ["BookHotel", "BookFlight", "BookRental", "CancelRental", "CancelFlight", "CancelHotel",
+                   "BookHotel", "BookFlight", "BookRental"])
+
+    def test_saga_idempotency_map(self):
+        from halolib.saga_store import LocalCompletionStore, set_completion_store
+        sagax = load_test_saga("saga_map.json")
+        done = []
+
+        def reserve(api, results, payload):
+            done.append(payload["sku"])
+            return {"sku": payload["sku"]}
+
+        payloads = {"ReserveItems": {"items": [{"sku": str(i)} for i in range(5)]}}
+        apis = {"ReserveItem": reserve, "ReleaseItem": reserve}
+        set_completion_store(LocalCompletionStore(60))
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                first = sagax.execute(req_context, payloads, apis)
+                second = sagax.execute(req_context, payloads, apis)
+        finally:
+            set_completion_store(None)
+        eq_([item["$.ReserveItemResult"]["sku"] for item in first["$.ReserveItemsResult"]], ["0", "1", "2", "3", "4"])
+        eq_(second, first)
+        eq_(sorted(done), ["0", "1", "2", "3", "4"])
+
+    def test_saga_idempotency_parallel(self):
+        from halolib.saga_store import LocalCompletionStore, set_completion_store
+
+        def add_pay(states):
+            del states["BookTrip"]["End"]
+            states["BookTrip"]["Next"] = "Pay"
+            states["Pay"] = {"Type": "Task", "Resource": "Google", "ResultPath": "$.PayResult", "End": True,
+                             "Catch": [{"ErrorEquals": ["States.ALL"], "ResultPath": "$.PayError",
+                                        "Next": "CancelTrip"}]}
+            states["CancelTrip"] = {"Type": "Task", "Resource": "Google", "ResultPath": "$.CancelTripResult",
+                                    "Next": "Fail"}
+
+        sagax = load_test_saga("saga_parallel.json", add_pay)
+        done = []
+        payloads, apis = booking(done, BOOKING + ["Pay", "CancelTrip"])
+        pay = apis["Pay"]
+        apis["Pay"] = fail_api("no money", done)
+        set_completion_store(LocalCompletionStore(60))
+        try:
+            with app.test_request_context(method='GET', path='/?a=b'):
+                req_context = Util.get_req_context(request)
+                try:
+                    sagax.execute(req_context, payloads, apis)
+                except saga.SagaRollBack:
+                    pass
+                eq_(sorted(done), ["BookFlight", "BookHotel", "BookRental", "CancelTrip", "Pay"])
+                del done[:]
+                apis["Pay"] = pay
+                sagax.execute(req_context, payloads, apis)
+        finally:
+            set_completion_store(None)
+        eq_(sorted(done), ["BookFlight", "BookHotel", "BookRental", "Pay"])
+
+    def test_saga_choice(self):
+        sagax = load_test_saga("saga_choice.json", schema=True)
+        done = []
+        flight = {}
+
+        def book_flight(api, results, payload):
+            done.append(payload["name"])
+            return flight
+
+        payloads, apis = booking(done, BOOKING + ["Confirm"], BookFlight=book_flight)
+        with app.test_request_context(method='GET', path='/?a=b'):
+            req_context = Util.get_req_context(request)
+            flight["domestic"] = True
+            sagax.execute(req_context, payloads, apis)
+            eq_(done, ["BookHotel", "BookFlight", "Confirm"])
+            del done[:]
+            flight["domestic"] = False
+            sagax.execute(req_context, payloads, apis)
+            eq_(done, ["BookHotel", "BookFlight", "BookRental", "Confirm"])
+        rule = saga.compile_rule({"And": [{"Variable": "$.r.price", "NumericLessThanEquals": 100},
+                                          {"Variable": "$.r.code", "StringMatches": "LH*"},
+                                          {"Variable": "$.r.at", "TimestampGreaterThan": "2016-03-14T01:59:00Z"}]})
+        eq_(rule({"$.r": {"price": 99, "code": "LH400", "at": "2016-03-14T02:00:00Z"}}), True)
+        eq_(rule({"$.r": {"price": "99", "code": "LH400", "at": "2016-03-14T02:00:00Z"}}), False)
+        eq_(rule({}), False)
+
+    def test_saga_batch(self):
+        sagax = load_test_saga("saga.json")
+
+        def book(api, results, payload):
+            if payload.get("fail"):
+                err = ApiError("sold out")
+                err.status_code = 503
+                raise err
+            return {"id": payload["order"]}
+
+        apis = {name: book for name in BOOKING}
+        payloads_list = [{name: {"order": i, "fail": i == 3 and name == "BookRental"} for name in BOOKING}
+                         for i in range(20)]
+        batch = saga.SagaBatch(sagax, apis, max_workers=4)
+        with app.test_request_context(method='GET', path='/?a=b'):
+            outcomes = {index: outcome for (index, outcome, value) in
+                        batch.run(Util.get_req_context(request), payloads_list)}
+        eq_(len(outcomes), 20)
+        eq_(outcomes[3], "rollback")
+        eq_(batch.metrics["commit"], 19)
+        eq_(batch.metrics["sagas"], 20)
+
+    def test_saga_paths(self):
+        def paths(states):
+            states["BookFlight"]["InputPath"] = "$.BookHotelResult"
+            states["BookFlight"]["ResultSelector"] = {"flight.$": "$.id", "kind": "flight"}
+            states["BookFlight"]["OutputPath"] = "$.flight"
+            states["BookRental"]["ResultPath"] = None
+
+        sagax = load_test_saga("saga.json", paths, schema=True)
+        inputs = {}
+
+        def book(api, results, payload):
+            inputs[payload["name"]] = results
+            return {"id": payload["name"]}
+
+        payloads, apis = booking()
+        apis = {name: book for name in apis}
+        with app.test_request_context(method='GET', path='/?a=b'):
+            ret = sagax.execute(Util.get_req_context(request), payloads, apis)
+        eq_(inputs["BookFlight"], {"id": "BookHotel"})
+        eq_(ret, {"$.BookHotelResult": {"id": "BookHotel"}, "$.BookFlightResult": "BookFlight"})
+
+    def test_saga_analyzer(self):
+        from halolib.saga_analyzer import analyze_saga
+        with open("saga.json") as f:
+            jsonx = json.load(f)
+        jsonx["States"]["Orphan"] = {"Type": "Task", "Resource": "Google", "End": True}
+        ret = analyze_saga(jsonx, {"Google": 100}, timeout_ms=500)
+        eq_(ret["unreachable"], ["Orphan"])
+        assert ["CancelRental", "CancelRental"] in ret["cycles"]
+        eq_(ret["forward_ms"], 300)
+        eq_(ret["compensation_path"], ["CancelRental", "CancelFlight", "CancelHotel", "Fail"])
+        eq_(ret["worst_case_ms"], 600)
+        eq_(ret["fits"], False)
+
+    def test_async_saga(self):
+        import asyncio
+        from halolib.saga_async import AsyncSaga
+        sagax = AsyncSaga(load_test_saga("saga.json"))
+        done = []
+
+        def slow(api, results, payload):
+            done.append(payload["name"])
+            return asyncio.sleep(1, result={})
+
+        payloads, apis = booking(done)
+        loop = asyncio.new_event_loop()
+        with app.test_request_context(method='GET', path='/?a=b'):
+            req_context = Util.get_req_context(request)
+            ret = loop.run_until_complete(sagax.execute(req_context, payloads, apis))
+            eq_(sorted(ret.keys()), ["$.BookFlightResult", "$.BookHotelResult", "$.BookRentalResult"])
+            del done[:]
+            apis["BookRental"] = slow
+            try:
+                loop.run_until_complete(sagax.execute(req_context, payloads, apis, timeout=0.2))
+                assert False
+            except saga.SagaRollBack as e:
+                eq_(e.args[0].status_code, "States.Timeout")
+        loop.close()
+        eq_(done, ["BookHotel", "BookFlight", "BookRental", "CancelRental", "CancelFlight", "CancelHotel"])
+
     def test_run_saga(self):
         response = requests.put(self.url)
         eq_(response.status_code, status.HTTP_200_OK)